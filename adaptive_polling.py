@@ -0,0 +1,116 @@
+import logging
+import math
+import time
+from typing import Dict, List
+
+from metrics import Metrics
+from profile_monitor import ProfileBatchWatcher, ProfileMonitor
+
+
+class PollingState():
+
+    def __init__(self, change_rate: float, next_poll_time: float, interval: float):
+        # Estimated profile changes per second.
+        self.change_rate = change_rate
+        self.rate_update_time = time.monotonic()
+        self.seen_watch_count = 0
+        self.last_poll_time = next_poll_time - interval
+        self.next_poll_time = next_poll_time
+        self.interval = interval
+
+
+class AdaptivePollingScheduler():
+    # Poll each profile at an interval adapted to how often it changes. The change rate is an exponentially
+    # weighted moving average of the changes found by the polls, and the interval is chosen so that about
+    # changes_per_poll changes are expected per poll, bounded by min_interval and max_interval. When the
+    # intervals of all the monitors need more requests than request_budget per second, they are stretched evenly, but
+    # never beyond max_interval, so the budget may not be met when it is below the rate of polling at max_interval.
+    changes_per_poll = 0.1
+    change_rate_half_life = 1800
+
+    def __init__(self, batch_watcher: ProfileBatchWatcher, initial_interval: float, min_interval: float,
+                 max_interval: float, request_budget: float):
+        assert 0 < min_interval <= max_interval
+        self.batch_watcher = batch_watcher
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.request_budget = request_budget
+        # A bulk request polls batch_size monitors.
+        self.monitors_per_request = max(batch_watcher.batch_size, 1)
+        initial_interval = min(max(initial_interval, min_interval), max_interval)
+        now = time.monotonic()
+        self.states = dict()
+        for i, monitor in enumerate(batch_watcher.monitor_list):
+            # Spread the first polls over the initial interval.
+            self.states[monitor] = PollingState(self.changes_per_poll / initial_interval,
+                                                now + initial_interval * i / len(batch_watcher.monitor_list),
+                                                initial_interval)
+        self.budget_scale = 1
+        self.budget_met = True
+        self.logger = logging.getLogger('adaptive-polling')
+
+    def _update_change_rate(self, monitor: ProfileMonitor, state: PollingState, now: float):
+        if monitor.watch_count == state.seen_watch_count:
+            return
+        state.seen_watch_count = monitor.watch_count
+        decay = math.exp(-(now - state.rate_update_time) * math.log(2) / self.change_rate_half_life)
+        state.change_rate *= decay
+        if monitor.last_changed:
+            state.change_rate += math.log(2) / self.change_rate_half_life
+        state.rate_update_time = now
+
+    def _get_intervals(self) -> Dict[ProfileMonitor, float]:
+        intervals = {
+            monitor:
+                min(max(self.changes_per_poll / max(state.change_rate, 1e-9), self.min_interval), self.max_interval)
+            for monitor, state in self.states.items()
+        }
+        request_rate = sum(1 / interval for interval in intervals.values()) / self.monitors_per_request
+        budget_scale = max(request_rate / self.request_budget, 1) if self.request_budget > 0 else 1
+        if (budget_scale > 1) != (self.budget_scale > 1):
+            self.logger.warning('Request rate {:.3f}/s, budget {:.3f}/s, intervals stretched by {:.2f}x'.format(
+                request_rate, self.request_budget, budget_scale))
+        self.budget_scale = budget_scale
+        intervals = {monitor: min(interval * budget_scale, self.max_interval) for monitor, interval in intervals.items()}
+        scaled_request_rate = sum(1 / interval for interval in intervals.values()) / self.monitors_per_request
+        budget_met = self.request_budget <= 0 or scaled_request_rate <= self.request_budget * 1.001
+        if budget_met != self.budget_met:
+            if budget_met:
+                self.logger.warning('Request budget {:.3f}/s is met again'.format(self.request_budget))
+            else:
+                self.logger.warning(
+                    'Request budget {:.3f}/s can not be met within max interval {}s, request rate {:.3f}/s'.format(
+                        self.request_budget, self.max_interval, scaled_request_rate))
+        self.budget_met = budget_met
+        return intervals
+
+    def _get_due_monitor_list(self) -> List[ProfileMonitor]:
+        now = time.monotonic()
+        for monitor, state in self.states.items():
+            self._update_change_rate(monitor, state, now)
+        due_monitor_list = []
+        for monitor, interval in self._get_intervals().items():
+            state = self.states[monitor]
+            state.interval = interval
+            Metrics.set('profile_poll_interval_seconds', interval, title=monitor.title)
+            # A change shortens the interval, so the next poll may come earlier than planned.
+            state.next_poll_time = min(state.next_poll_time, state.last_poll_time + interval)
+            if state.next_poll_time > now or self.batch_watcher.is_pending(monitor):
+                continue
+            state.last_poll_time = now
+            state.next_poll_time = now + interval
+            due_monitor_list.append(monitor)
+        return due_monitor_list
+
+    def tick(self):
+        due_monitor_list = self._get_due_monitor_list()
+        if due_monitor_list:
+            self.batch_watcher.watch(due_monitor_list)
+
+    async def tick_async(self):
+        due_monitor_list = self._get_due_monitor_list()
+        if due_monitor_list:
+            await self.batch_watcher.watch_async(due_monitor_list)
+
+    def status(self) -> dict:
+        return {monitor.title: round(state.interval, 1) for monitor, state in self.states.items()}
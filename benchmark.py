@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+import timeit
+
+import bs4
+import click
+from x_client_transaction import ClientTransaction
+
+from outbox import Outbox
+from transaction_id import TransactionIdGenerator
+from tweet_view import TweetView
+from utils import find_all, find_one, get_content, parse_media_from_tweet, TIMELINE_TWEET_RESULTS
+
+
+def _load_json(path: str):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _print_result(name: str, old_cost: float, new_cost: float, number: int):
+    print('{}: old {:.3f} ms, new {:.3f} ms, speedup {:.1f}x'.format(name, old_cost / number * 1000,
+                                                                     new_cost / number * 1000, old_cost / new_cost))
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command(context_settings={'show_default': True})
+@click.option('--payload',
+              'payload_path_list',
+              multiple=True,
+              required=True,
+              help="Recorded UserTweetsAndReplies / Likes response json file")
+@click.option('--number', default=100, help="Repeat times")
+def extractor(payload_path_list, number):
+    # Compare the compiled path extractors with the BFS / DFS searches.
+    for payload_path in payload_path_list:
+        payload = _load_json(payload_path)
+
+        def _old():
+            return [find_one(tweet, 'legacy') for tweet in find_all(payload, 'tweet_results')]
+
+        def _new():
+            return [get_content(tweet) for tweet in TIMELINE_TWEET_RESULTS.extract_all(payload)]
+
+        assert _old() == _new(), 'Extract results mismatch: {}'.format(payload_path)
+        print('{}: {} tweets'.format(payload_path, len(_new())))
+        _print_result('extractor', timeit.timeit(_old, number=number), timeit.timeit(_new, number=number), number)
+
+
+def _parse_tweet_by_search(tweet: dict) -> tuple:
+    # The repeated find_one walks used by the tweet / like monitors before TweetView
+    user = find_one(tweet, 'user_results')
+    is_advertiser = bool(
+        find_one(tweet, 'card') or find_one(tweet, 'userLabelType') == 'BusinessLabel' or
+        find_one(tweet, '__typename') == 'TweetWithVisibilityResultss' or
+        'dvertiser' in (find_one(tweet, 'source') or ''))
+    content = get_content(tweet)
+    retweet = find_one(tweet, 'retweeted_status_result')
+    quote = find_one(tweet, 'quoted_status_result')
+    quote_username = find_one(find_one(quote, 'user_results'), 'screen_name') if quote else None
+    return (find_one(tweet, 'rest_id'), find_one(user, 'rest_id'), find_one(user, 'screen_name'), is_advertiser,
+            content.get('created_at'), content.get('full_text'), parse_media_from_tweet(retweet or tweet),
+            find_one(tweet, 'source'), quote_username)
+
+
+def _parse_tweet_by_view(tweet: dict) -> tuple:
+    view = TweetView(tweet)
+    media_view = view.retweet or view
+    return (view.rest_id, view.user_id, view.screen_name, view.is_advertiser(), view.content.get('created_at'),
+            view.full_text, (media_view.photo_url_list,
+                             media_view.video_url_list), view.source, view.quote.screen_name if view.quote else None)
+
+
+@cli.command(context_settings={'show_default': True})
+@click.option('--payload',
+              'payload_path_list',
+              multiple=True,
+              required=True,
+              help="Recorded UserTweetsAndReplies / Likes response json file")
+@click.option('--number', default=20, help="Repeat times")
+def tweet_view(payload_path_list, number):
+    # Compare TweetView with the per-field find_one walks, html to text conversion excluded.
+    for payload_path in payload_path_list:
+        tweet_list = TIMELINE_TWEET_RESULTS.extract_all(_load_json(payload_path))
+
+        def _old():
+            return [_parse_tweet_by_search(tweet) for tweet in tweet_list]
+
+        def _new():
+            return [_parse_tweet_by_view(tweet) for tweet in tweet_list]
+
+        print('{}: {} tweets'.format(payload_path, len(tweet_list)))
+        _print_result('tweet-view', timeit.timeit(_old, number=number), timeit.timeit(_new, number=number), number)
+
+
+@cli.command(context_settings={'show_default': True})
+@click.option('--payload',
+              'payload_path_list',
+              multiple=True,
+              required=True,
+              help="Recorded UserTweetsAndReplies / Likes response json file")
+@click.option('--number', default=20, help="Repeat times")
+def html_to_text(payload_path_list, number):
+    # Compare the parser free fast path and the memoized sources with parsing every text and source.
+    for payload_path in payload_path_list:
+        view_list = [TweetView(tweet) for tweet in TIMELINE_TWEET_RESULTS.extract_all(_load_json(payload_path))]
+
+        def _old():
+            return [(bs4.BeautifulSoup(view.full_text, 'html.parser').get_text(),
+                     bs4.BeautifulSoup(view.source, 'html.parser').get_text() if view.source else '')
+                    for view in view_list]
+
+        def _new():
+            return [(view.text, view.source_text) for view in view_list]
+
+        mismatch_count = sum(old != new for old, new in zip(_old(), _new()))
+        print('{}: {} tweets, {} mismatches'.format(payload_path, len(view_list), mismatch_count))
+        cost_old, cost_new = timeit.timeit(_old, number=number), timeit.timeit(_new, number=number)
+        _print_result('html-to-text per tweet', cost_old / max(len(view_list), 1), cost_new / max(len(view_list), 1),
+                      number)
+
+
+@cli.command(context_settings={'show_default': True})
+@click.option('--messages', default=5000, help="Number of messages put by each thread")
+@click.option('--threads', default=4, help="Number of threads putting messages, like the monitors")
+def outbox(messages, threads):
+    # Compare the group committed outbox with writing and fsyncing every record before returning.
+    text = 'Follow: @username\nName: name\nBio: ' + 'x' * 160
+    photo_url_list = ['https://pbs.twimg.com/profile_images/0/photo.jpg']
+
+    def _run(put):
+        put_cost_list = []
+
+        def _put_messages():
+            for _ in range(messages):
+                start_time = time.perf_counter()
+                put()
+                put_cost_list.append(time.perf_counter() - start_time)
+
+        thread_list = [threading.Thread(target=_put_messages) for _ in range(threads)]
+        start_time = time.perf_counter()
+        for thread in thread_list:
+            thread.start()
+        for thread in thread_list:
+            thread.join()
+        return time.perf_counter() - start_time, sorted(put_cost_list)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        lock = threading.Lock()
+        f = open(os.path.join(temp_dir, 'sync.jsonl'), 'a')
+
+        def _sync_put():
+            with lock:
+                f.write(json.dumps({'op': 'put', 'text': text, 'photo_url_list': photo_url_list}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+        journal = Outbox(os.path.join(temp_dir, 'outbox.jsonl'))
+
+        def _outbox_put():
+            journal.put(0, text, photo_url_list, None)
+
+        sync_cost, sync_put_cost_list = _run(_sync_put)
+        f.close()
+        outbox_cost, outbox_put_cost_list = _run(_outbox_put)
+        start_time = time.perf_counter()
+        journal.flush()
+        outbox_cost += time.perf_counter() - start_time
+
+    count = messages * threads
+    for name, cost, put_cost_list in (('fsync per message', sync_cost, sync_put_cost_list), ('outbox', outbox_cost,
+                                                                                             outbox_put_cost_list)):
+        print('{}: {:.0f} messages/s durable, put p50 {:.3f} ms, p99 {:.3f} ms'.format(
+            name, count / cost, put_cost_list[len(put_cost_list) // 2] * 1000,
+            put_cost_list[int(len(put_cost_list) * 0.99)] * 1000))
+
+
+@cli.command(context_settings={'show_default': True})
+@click.option('--home_page', 'home_page_path', required=True, help="Saved https://x.com home page html file")
+@click.option('--ondemand_file', 'ondemand_file_path', required=True, help="Saved ondemand.s js file")
+@click.option('--number', default=10000, help="Repeat times")
+def transaction_id(home_page_path, ondemand_file_path, number):
+    # Compare TransactionIdGenerator with ClientTransaction.generate_transaction_id.
+    with open(home_page_path, 'r') as f:
+        home_page_response = bs4.BeautifulSoup(f.read(), 'html.parser')
+    with open(ondemand_file_path, 'r') as f:
+        ct = ClientTransaction(home_page_response=home_page_response, ondemand_file_response=f.read())
+    generator = TransactionIdGenerator(ct.key, ct.animation_key, ct.random_keyword, ct.random_number)
+    method, path = 'GET', '/i/api/graphql/xmU6X_CKVnQ5lSrCbAmJsg/UserTweetsAndReplies'
+
+    def _decode(transaction_id: str) -> bytes:
+        # Strip the random byte, the rest of the id is xored with it.
+        data = base64.b64decode(transaction_id + '=' * (-len(transaction_id) % 4))
+        return bytes(b ^ data[0] for b in data[1:])
+
+    # The ids only differ by the random byte, unless the second changes in between.
+    assert any(
+        _decode(ct.generate_transaction_id(method=method, path=path)) == _decode(generator.generate(method, path))
+        for _ in range(3)), 'Transaction id mismatch'
+
+    def _old():
+        return ct.generate_transaction_id(method=method, path=path)
+
+    def _new():
+        return generator.generate(method, path)
+
+    _print_result('transaction-id', timeit.timeit(_old, number=number), timeit.timeit(_new, number=number), number)
+
+
+if __name__ == '__main__':
+    cli()
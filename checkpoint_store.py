@@ -0,0 +1,66 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Union
+
+
+class CheckpointStore():
+    # Monitor states saved after each successful watch, so that a restart does not need to re-baseline.
+    initialized = False
+
+    def __new__(cls):
+        raise Exception('Do not instantiate this class!')
+
+    @classmethod
+    def init(cls, path: str):
+        cls.logger = logging.getLogger('checkpoint')
+        cls.lock = threading.Lock()
+        cls.connection = sqlite3.connect(path, check_same_thread=False)
+        cls.connection.execute('PRAGMA journal_mode=WAL')
+        cls.connection.execute('CREATE TABLE IF NOT EXISTS checkpoint (monitor_type TEXT, title TEXT, username TEXT, '
+                               'user_id TEXT, data TEXT, update_time REAL, PRIMARY KEY (monitor_type, title))')
+        cls.connection.commit()
+        # sha1 of the last saved data of each monitor, to skip saving unchanged checkpoints.
+        cls.last_saved_hashes = dict()
+        cls.initialized = True
+
+    @classmethod
+    def load(cls, monitor_type: str, title: str, username: str) -> Union[dict, None]:
+        if not cls.initialized:
+            return None
+        with cls.lock:
+            row = cls.connection.execute(
+                'SELECT data, update_time FROM checkpoint WHERE monitor_type = ? AND title = ? AND username = ?',
+                (monitor_type, title, username)).fetchone()
+        if not row:
+            return None
+        cls.last_saved_hashes[(monitor_type, title)] = hashlib.sha1(row[0].encode()).digest()
+        checkpoint = json.loads(row[0])
+        cls.logger.info('Load checkpoint {}-{} saved at {}'.format(monitor_type, title, time.ctime(row[1])))
+        return checkpoint
+
+    @classmethod
+    def save(cls, monitor_type: str, title: str, username: str, user_id: str, checkpoint: dict):
+        if not cls.initialized:
+            return
+        data = json.dumps(checkpoint, sort_keys=True)
+        data_hash = hashlib.sha1(data.encode()).digest()
+        with cls.lock:
+            if cls.last_saved_hashes.get((monitor_type, title), None) == data_hash:
+                return
+            cls.connection.execute('INSERT OR REPLACE INTO checkpoint VALUES (?, ?, ?, ?, ?, ?)',
+                                   (monitor_type, title, username, user_id, data, time.time()))
+            cls.connection.commit()
+            cls.last_saved_hashes[(monitor_type, title)] = data_hash
+
+    @classmethod
+    def get_user_id(cls, username: str) -> Union[str, None]:
+        if not cls.initialized:
+            return None
+        with cls.lock:
+            row = cls.connection.execute('SELECT user_id FROM checkpoint WHERE username = ? LIMIT 1',
+                                         (username,)).fetchone()
+        return row[0] if row else None
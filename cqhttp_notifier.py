@@ -3,7 +3,7 @@ import requests
 
 from typing import List, Union
 
-from notifier_base import Message, NotifierBase
+from notifier_base import Message, NotifierBase, Priority
 
 
 def _remove_http(text: str) -> str:
@@ -13,14 +13,24 @@ def _remove_http(text: str) -> str:
     return text
 
 
+def _escape_cq_text(text: str) -> str:
+    # Escape the characters of CQ codes, https://docs.go-cqhttp.org/cqcode/
+    return text.replace('&', '&amp;').replace('[', '&#91;').replace(']', '&#93;')
+
+
+def _escape_cq_param(value: str) -> str:
+    return _escape_cq_text(value).replace(',', '&#44;')
+
+
 class CqhttpMessage(Message):
 
     def __init__(self,
                  url_list: List[str],
                  text: str,
                  photo_url_list: Union[List[str], None] = None,
-                 video_url_list: Union[List[str], None] = None):
-        super().__init__(text, photo_url_list, video_url_list)
+                 video_url_list: Union[List[str], None] = None,
+                 priority: Priority = Priority.NORMAL):
+        super().__init__(text, photo_url_list, video_url_list, priority)
         self.url_list = url_list
 
 
@@ -28,43 +38,58 @@ class CqhttpNotifier(NotifierBase):
     notifier_name = 'Cqhttp'
 
     @classmethod
-    def init(cls, token: str, logger_name: str):
+    def init(cls,
+             token: str,
+             logger_name: str,
+             concurrency: int = 1,
+             coalesce_window: float = 0,
+             outbox_dir: str = '',
+             queue_capacity: int = 1000):
         cls.headers = {'Authorization': 'Bearer {}'.format(token)} if token else None
+        cls.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max(concurrency, 1), pool_maxsize=max(concurrency, 1))
+        cls.session.mount('https://', adapter)
+        cls.session.mount('http://', adapter)
         cls.logger = logging.getLogger('{}'.format(logger_name))
         cls.logger.info('Init cqhttp notifier succeed.')
-        super().init()
+        super().init(concurrency, coalesce_window, outbox_dir, queue_capacity)
 
     @classmethod
     def _post_request_to_cqhttp(cls, url: str, data: dict):
-        response = requests.post(url, headers=cls.headers, data=data, timeout=60)
+        response = cls.session.post(url, headers=cls.headers, data=data, timeout=60)
         if response.status_code != 200 or response.json().get('status', '') != 'ok':
             raise RuntimeError('Post request error: {}, {}\nurl: {}\ndata: {}'.format(
                 response.status_code, response.text, url, str(data)))
 
     @classmethod
-    def _send_text_to_single_chat(cls, url: str, text: str):
-        data = {'message': _remove_http(text)}
+    def _send_text_and_photos_to_single_chat(cls, url: str, text: str, photo_url_list: List[str]):
+        # The text and the image segments are combined into one message.
+        message = _escape_cq_text(_remove_http(text)) + ''.join(
+            '[CQ:image,file={}]'.format(_escape_cq_param(photo_url)) for photo_url in photo_url_list)
+        data = {'message': message}
         cls._post_request_to_cqhttp(url, data)
 
     @classmethod
-    def _send_photo_to_single_chat(cls, url: str, photo_url: str):
-        data = {'message': '[CQ:image,file={}]'.format(photo_url)}
+    def _send_video_to_single_chat(cls, url: str, video_url: str):
+        # A video segment can only be sent alone.
+        data = {'message': '[CQ:video,file={}]'.format(_escape_cq_param(video_url))}
         cls._post_request_to_cqhttp(url, data)
 
     @classmethod
-    def _send_video_to_single_chat(cls, url: str, video_url: str):
-        data = {'message': '[CQ:video,file={}]'.format(video_url)}
-        cls._post_request_to_cqhttp(url, data)
+    def get_destination_list(cls, message: CqhttpMessage) -> List[str]:
+        assert isinstance(message, CqhttpMessage)
+        return message.url_list
+
+    @classmethod
+    def build_message(cls, url: str, text: str, photo_url_list: Union[List[str], None],
+                      video_url_list: Union[List[str], None]) -> CqhttpMessage:
+        return CqhttpMessage([url], text, photo_url_list, video_url_list)
 
     @classmethod
-    def send_message(cls, message: CqhttpMessage):
+    def send_message_to_destination(cls, url: str, message: CqhttpMessage):
         assert cls.initialized
         assert isinstance(message, CqhttpMessage)
-        for url in message.url_list:
-            cls._send_text_to_single_chat(url, message.text)
-            if message.photo_url_list:
-                for photo_url in message.photo_url_list:
-                    cls._send_photo_to_single_chat(url, photo_url)
-            if message.video_url_list:
-                for video_url in message.video_url_list:
-                    cls._send_video_to_single_chat(url, video_url)
+        cls._send_text_and_photos_to_single_chat(url, message.text, message.photo_url_list or [])
+        if message.video_url_list:
+            for video_url in message.video_url_list:
+                cls._send_video_to_single_chat(url, video_url)
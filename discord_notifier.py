@@ -1,9 +1,11 @@
 import logging
+import threading
+import time
 from typing import List, Union
 
 import requests
 
-from notifier_base import Message, NotifierBase
+from notifier_base import Message, NotifierBase, Priority
 
 
 class DiscordMessage(Message):
@@ -12,41 +14,130 @@ class DiscordMessage(Message):
                  webhook_url_list: List[str],
                  text: str,
                  photo_url_list: Union[List[str], None] = None,
-                 video_url_list: Union[List[str], None] = None):
-        super().__init__(text, photo_url_list, video_url_list)
+                 video_url_list: Union[List[str], None] = None,
+                 priority: Priority = Priority.NORMAL):
+        super().__init__(text, photo_url_list, video_url_list, priority)
         self.webhook_url_list = webhook_url_list
 
 
 class DiscordNotifier(NotifierBase):
     notifier_name = 'Discord'
+    # https://discord.com/developers/docs/resources/webhook#execute-webhook
+    digest_text_limit = 2000
+    digest_caption_limit = 2000
+    digest_media_limit = 10
+    content_limit = 2000
+    embed_limit = 10
+    max_rate_limited_tries = 5
 
     @classmethod
-    def init(cls, logger_name: str):
+    def init(cls,
+             logger_name: str,
+             concurrency: int = 1,
+             coalesce_window: float = 0,
+             outbox_dir: str = '',
+             queue_capacity: int = 1000):
         cls.logger = logging.getLogger('{}'.format(logger_name))
+        cls.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max(concurrency, 1), pool_maxsize=max(concurrency, 1))
+        cls.session.mount('https://', adapter)
+        cls.session.mount('http://', adapter)
+        # https://discord.com/developers/docs/topics/rate-limits
+        cls.rate_limit_lock = threading.Lock()
+        cls.url_buckets = dict()
+        cls.bucket_reset_times = dict()
+        cls.global_reset_time = 0
         cls.logger.info('Init discord notifier succeed.')
-        super().init()
+        super().init(concurrency, coalesce_window, outbox_dir, queue_capacity)
+
+    @classmethod
+    def _wait_rate_limit(cls, url: str):
+        with cls.rate_limit_lock:
+            reset_time = max(cls.global_reset_time, cls.bucket_reset_times.get(cls.url_buckets.get(url, None), 0))
+        wait_time = reset_time - time.monotonic()
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    @staticmethod
+    def _get_retry_after(response: requests.Response) -> float:
+        # A 429 from a proxy or cloudflare may not have a json body, fall back to the headers then.
+        try:
+            retry_after = response.json().get('retry_after', None)
+        except (ValueError, AttributeError):
+            retry_after = None
+        if retry_after is None:
+            retry_after = response.headers.get('Retry-After', None) or response.headers.get(
+                'X-RateLimit-Reset-After', None)
+        try:
+            return float(retry_after) if retry_after is not None else 1
+        except ValueError:
+            return 1
+
+    @classmethod
+    def _update_rate_limit(cls, url: str, response: requests.Response):
+        bucket = response.headers.get('X-RateLimit-Bucket', None)
+        now = time.monotonic()
+        with cls.rate_limit_lock:
+            if bucket:
+                cls.url_buckets[url] = bucket
+                if response.headers.get('X-RateLimit-Remaining', None) == '0':
+                    cls.bucket_reset_times[bucket] = now + float(response.headers.get('X-RateLimit-Reset-After', 0))
+                else:
+                    cls.bucket_reset_times.pop(bucket, None)
+            if response.status_code == 429:
+                retry_after = cls._get_retry_after(response)
+                if response.headers.get('X-RateLimit-Global', None) or not bucket:
+                    cls.global_reset_time = now + retry_after
+                else:
+                    cls.bucket_reset_times[bucket] = now + retry_after
 
     @classmethod
     def _post_request_to_discord(cls, url: str, data: dict):
-        response = requests.post(url, json=data, timeout=60)
-        if response.status_code != 204:  # Discord webhook returns 204 No Content on success
+        for _ in range(cls.max_rate_limited_tries):
+            cls._wait_rate_limit(url)
+            response = cls.session.post(url, json=data, timeout=60)
+            cls._update_rate_limit(url, response)
+            if response.status_code != 429:
+                break
+            cls.logger.warning('Rate limited: {}'.format(response.text))
+        if not response.ok:  # Discord webhook returns 204 No Content on success
             raise RuntimeError('Post request error: {}, {}\nurl: {}\ndata: {}'.format(
                 response.status_code, response.text, url, str(data)))
 
     @classmethod
-    def _send_text_to_discord(cls, url: str, text: str):
-        data = {'content': text}
-        cls._post_request_to_discord(url, data)
+    def get_destination_list(cls, message: DiscordMessage) -> List[str]:
+        assert isinstance(message, DiscordMessage)
+        return message.webhook_url_list
+
+    @classmethod
+    def get_destination_name(cls, url: str) -> str:
+        # https://discord.com/api/webhooks/{webhook_id}/{webhook_token}
+        return url.rstrip('/').split('/')[-2]
+
+    @classmethod
+    def build_message(cls, url: str, text: str, photo_url_list: Union[List[str], None],
+                      video_url_list: Union[List[str], None]) -> DiscordMessage:
+        return DiscordMessage([url], text, photo_url_list, video_url_list)
 
     @classmethod
-    def send_message(cls, message: DiscordMessage):
+    def send_message_to_destination(cls, url: str, message: DiscordMessage):
         assert cls.initialized
         assert isinstance(message, DiscordMessage)
-        for url in message.webhook_url_list:
-            cls._send_text_to_discord(url, message.text)
-            if message.photo_url_list:
-                for photo_url in message.photo_url_list:
-                    cls._send_text_to_discord(url, photo_url)
-            if message.video_url_list:
-                for video_url in message.video_url_list:
-                    cls._send_text_to_discord(url, video_url)
\ No newline at end of file
+        # Photos are sent as embeds and videos as links in the content, which discord displays inline.
+        video_links = '\n'.join(message.video_url_list or [])
+        content = '{}\n{}'.format(message.text, video_links) if video_links else message.text
+        if len(content) > cls.content_limit and video_links:
+            # Post the links by themselves rather than cutting the text to make room for them.
+            content = message.text
+        else:
+            video_links = ''
+        photo_url_list = message.photo_url_list or []
+        data = {'content': content[:cls.content_limit]}
+        for i in range(0, max(len(photo_url_list), 1), cls.embed_limit):
+            embeds = [{'image': {'url': photo_url}} for photo_url in photo_url_list[i:i + cls.embed_limit]]
+            if embeds:
+                data['embeds'] = embeds
+            cls._post_request_to_discord(url, data)
+            data = {}
+        if video_links:
+            cls._post_request_to_discord(url, {'content': video_links[:cls.content_limit]})
@@ -1,12 +1,17 @@
+import math
 import time
-from typing import Union, Tuple, Dict
+from typing import Union, Tuple, Dict, Iterable
 
-from monitor_base import MonitorBase
-from utils import find_all, find_one, get_cursor, get_content
+from monitor_base import MonitorBase, MonitorManager
+from notifier_base import Priority
+from utils import find_one, get_cursor, get_content, TIMELINE_USER_RESULTS
 
 
 class FollowingMonitor(MonitorBase):
     monitor_type = 'Following'
+    # Newest follows come first, so a few head pages are enough to find the new ones.
+    head_page_size = 50
+    full_reconcile_interval = 24 * 60 * 60
 
     def __init__(self, username: str, title: str, token_config: dict, user_config: dict, cookies_dir: str):
         super().__init__(monitor_type=self.monitor_type,
@@ -16,36 +21,99 @@ class FollowingMonitor(MonitorBase):
                          user_config=user_config,
                          cookies_dir=cookies_dir)
 
-        self.following_dict = self.get_all_following(self.user_id)
+        checkpoint = self.load_checkpoint()
+        if checkpoint:
+            self.following_dict = checkpoint['following_dict']
+            self.following_count = checkpoint.get('following_count', None)
+            self.last_full_reconcile_time = checkpoint.get('last_full_reconcile_time', 0)
+        else:
+            self.following_dict = self.get_all_following(self.user_id)
+            self.following_count = self.get_profile_following_count()
+            self.last_full_reconcile_time = time.time()
+            self.save_checkpoint()
 
         self.logger.info('Init following monitor succeed.\nUser id: {}\nFollowing {} users: {}'.format(
             self.user_id, len(self.following_dict),
             [find_one(following, 'screen_name') for following in self.following_dict.values()]))
 
     def get_all_following(self, user_id: int) -> Dict[str, dict]:
+        return self.get_following(user_id)[0]
+
+    def get_following(self,
+                      user_id: int,
+                      known_user_ids: Union[Iterable[str], None] = None,
+                      count: int = 1000,
+                      max_page_number: Union[int, None] = None) -> Tuple[Dict[str, dict], int, bool]:
+        # Returns following dict, page number, and whether it stopped at a page overlapping with known_user_ids.
+        # Stops without overlap after max_page_number pages.
         api_name = 'Following'
-        params = {'userId': user_id, 'includePromotedContent': True, 'count': 1000}
+        params = {'userId': user_id, 'includePromotedContent': True, 'count': count}
         following_dict = dict()
+        page_number = 0
 
         while True:
             json_response = self.twitter_watcher.query(api_name, params)
-            following_list = find_all(json_response, 'user_results')
+            following_list = TIMELINE_USER_RESULTS.extract_all(json_response)
             while not following_list and not find_one(json_response, 'result'):
                 import json
                 self.logger.error(json.dumps(json_response, indent=2))
                 time.sleep(10)
                 json_response = self.twitter_watcher.query(api_name, params)
-                following_list = find_all(json_response, 'user_results')
+                following_list = TIMELINE_USER_RESULTS.extract_all(json_response)
 
+            page_number += 1
+            overlapped = False
             for following in following_list:
                 user_id = find_one(following, 'rest_id')
                 following_dict[user_id] = following
+                if known_user_ids is not None and user_id in known_user_ids:
+                    overlapped = True
+            if overlapped:
+                return following_dict, page_number, True
+            if max_page_number is not None and page_number >= max_page_number:
+                break
 
             cursor = get_cursor(json_response)
             if not cursor or cursor.startswith('-1|') or cursor.startswith('0|'):
                 break
             params['cursor'] = cursor
 
+        return following_dict, page_number, False
+
+    def get_profile_following_count(self) -> Union[int, None]:
+        if MonitorManager.monitors is None:
+            # Monitors are not all initialized yet
+            return None
+        profile_monitor = MonitorManager.get(monitor_type='Profile', username=self.title)
+        if not profile_monitor:
+            return None
+        return profile_monitor.following_count.element
+
+    def get_incremental_following(self, following_count: Union[int, None]) -> Union[Dict[str, dict], None]:
+        # Returns None if the head pages can not explain the change of following count, a full reconcile is needed.
+        if following_count is None or self.following_count is None:
+            return None
+        if time.time() - self.last_full_reconcile_time > self.full_reconcile_interval:
+            return None
+        following_delta = following_count - self.following_count
+        if following_delta <= 0 or not self.following_dict:
+            # Unfollows can not be found from the head pages, nor can new follows without known ones to overlap.
+            return None
+        # The new follows fit in this many head pages, plus one to reach a known one. More pages without overlap mean
+        # the known following is stale, then a full reconcile with the larger pages is cheaper.
+        max_page_number = math.ceil(following_delta / self.head_page_size) + 1
+        head_following_dict, page_number, overlapped = self.get_following(self.user_id,
+                                                                          known_user_ids=self.following_dict.keys(),
+                                                                          count=self.head_page_size,
+                                                                          max_page_number=max_page_number)
+        new_user_id_set = head_following_dict.keys() - self.following_dict.keys()
+        self.logger.info('Incremental diff cost {} pages, found {} new following, expected {}.'.format(
+            page_number, len(new_user_id_set), following_delta))
+        if not overlapped or len(new_user_id_set) != following_delta:
+            return None
+        following_dict = head_following_dict
+        for user_id, following in self.following_dict.items():
+            following_dict.setdefault(user_id, following)
         return following_dict
 
     def parse_user_details(self, user: dict) -> Tuple[str, Union[str, None]]:
@@ -75,7 +143,9 @@ class FollowingMonitor(MonitorBase):
                 details_str, profile_image_url = self.parse_user_details(old_following_dict[dec_user_id])
                 if details_str:
                     message += '\n{}'.format(details_str)
-                self.send_message(message=message, photo_url_list=[profile_image_url] if profile_image_url else [])
+                self.send_message(message=message,
+                                  photo_url_list=[profile_image_url] if profile_image_url else [],
+                                  priority=Priority.BULK)
         if inc_user_id_list:
             self.logger.info('Follow: {}'.format(inc_user_id_list))
             for inc_user_id in inc_user_id_list:
@@ -83,16 +153,33 @@ class FollowingMonitor(MonitorBase):
                 details_str, profile_image_url = self.parse_user_details(new_following_dict[inc_user_id])
                 if details_str:
                     message += '\n{}'.format(details_str)
-                self.send_message(message=message, photo_url_list=[profile_image_url] if profile_image_url else [])
+                self.send_message(message=message,
+                                  photo_url_list=[profile_image_url] if profile_image_url else [],
+                                  priority=Priority.BULK)
         return True
 
     def watch(self) -> bool:
-        following_dict = self.get_all_following(self.user_id)
+        following_count = self.get_profile_following_count()
+        following_dict = self.get_incremental_following(following_count)
+        if following_dict is None:
+            following_dict, page_number, _ = self.get_following(self.user_id)
+            self.logger.info('Full reconcile cost {} pages, following {} users.'.format(
+                page_number, len(following_dict)))
+            self.last_full_reconcile_time = time.time()
         if not self.detect_changes(self.following_dict, following_dict):
             return False
         self.following_dict = following_dict
+        self.following_count = following_count
         self.update_last_watch_time()
+        self.save_checkpoint()
         return True
 
     def status(self) -> str:
         return 'Last: {}, number: {}'.format(self.get_last_watch_time(), len(self.following_dict))
+
+    def get_checkpoint(self) -> dict:
+        return {
+            'following_dict': self.following_dict,
+            'following_count': self.following_count,
+            'last_full_reconcile_time': self.last_full_reconcile_time
+        }
@@ -1,83 +1,209 @@
+import hashlib
+import json
 import logging
+import os
+import re
+import sys
+import threading
 import time
+from typing import Union
 
 import bs4
 import requests
 from x_client_transaction.utils import generate_headers, handle_x_migration, get_ondemand_file_url
 from x_client_transaction import ClientTransaction
 
+from transaction_id import TransactionIdGenerator
 from utils import check_initialized
 
+API_JSON_URL = 'https://github.com/ionic-bond/TwitterInternalAPIDocument/raw/master/docs/json/API.json'
+HOME_PAGE_URL = 'https://x.com'
+SITE_VERIFICATION_REGEX = re.compile(r'<meta\s+name=["\']twitter-site-verification["\']\s+content=["\']([^"\']+)["\']')
+
+
+def _get_conditional_headers(cached: dict) -> dict:
+    headers = dict()
+    if cached.get('etag', ''):
+        headers['If-None-Match'] = cached['etag']
+    if cached.get('last_modified', ''):
+        headers['If-Modified-Since'] = cached['last_modified']
+    return headers
+
+
+class ApiSnapshot():
+    # Everything a query needs from one refresh. It is replaced as a whole, so readers never see a half-updated mix.
+
+    def __init__(self, graphql_api_data: dict, headers: dict, transaction_id_generator: TransactionIdGenerator):
+        self.graphql_api_data = graphql_api_data
+        self.headers = headers
+        self.transaction_id_generator = transaction_id_generator
+
 
 class GraphqlAPI():
     initialized = False
+    snapshot = None
 
     def __new__(cls):
         raise Exception('Do not instantiate this class!')
 
     @classmethod
-    def init(cls) -> None:
+    def init(cls, cache_path: str = os.path.join(sys.path[0], 'graphql_api_cache.json')) -> None:
+        # Boot from the cached data without waiting for the network when there is a cache, and refresh it in the
+        # background. Called by every entry point which queries, does nothing when already initialized.
+        if cls.initialized:
+            return
         cls.logger = logging.getLogger('api')
+        cls.cache_path = cache_path
+        # The last good API.json with its validators, and the transaction key material with the fingerprint of the
+        # pages it is derived from.
+        cls.cache = dict()
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                try:
+                    cls.cache = json.load(f)
+                except ValueError:
+                    pass
+        if cls.cache.get('api_json', None) and cls.cache.get('transaction', None):
+            cls.snapshot = ApiSnapshot(cls.cache['api_json']['graphql'], cls.cache['api_json']['header'],
+                                       cls._build_transaction_id_generator(cls.cache['transaction']))
+            cls.initialized = True
+            cls.logger.info('Boot from cached GraphQL API data, API number: {}'.format(
+                len(cls.snapshot.graphql_api_data)))
+            threading.Thread(target=cls._update_until_success, daemon=True).start()
+            return
+        cls._update_until_success()
+        cls.initialized = True
+
+    @classmethod
+    def _update_until_success(cls):
         while not cls.update_api_data():
             time.sleep(10)
-        cls.initialized = True
+
+    @staticmethod
+    def _build_transaction_id_generator(transaction: dict) -> TransactionIdGenerator:
+        return TransactionIdGenerator(transaction['key'], transaction['animation_key'], transaction['random_keyword'],
+                                      transaction['random_number'])
+
+    @classmethod
+    def _save_cache(cls):
+        if not cls.cache_path:
+            return
+        with open(cls.cache_path + '.tmp', 'w') as f:
+            json.dump(cls.cache, f)
+        os.replace(cls.cache_path + '.tmp', cls.cache_path)
 
     @classmethod
-    def update_api_data(cls):
-        response = requests.get(
-            'https://github.com/ionic-bond/TwitterInternalAPIDocument/raw/master/docs/json/API.json', timeout=300)
+    def update_api_data(cls) -> bool:
+        try:
+            api_json = cls._update_api_json()
+            if not api_json:
+                return False
+            transaction = cls._update_transaction()
+        except Exception as e:
+            cls.logger.error('Update API data failed: {}'.format(e))
+            return False
+
+        old_snapshot = cls.snapshot
+        if old_snapshot and api_json is cls.cache.get('api_json', None) and transaction is cls.cache.get(
+                'transaction', None):
+            cls.logger.info('GraphQL API data not changed')
+            return True
+        if old_snapshot and transaction is cls.cache.get('transaction', None):
+            transaction_id_generator = old_snapshot.transaction_id_generator
+        else:
+            transaction_id_generator = cls._build_transaction_id_generator(transaction)
+        cls.snapshot = ApiSnapshot(api_json['graphql'], api_json['header'], transaction_id_generator)
+        cls.cache = {'api_json': api_json, 'transaction': transaction}
+        cls._save_cache()
+        cls.logger.info('Pull GraphQL API data success, API number: {}'.format(len(api_json['graphql'])))
+        return True
+
+    @classmethod
+    def _update_api_json(cls) -> Union[dict, None]:
+        # Returns the cached API.json as is when it is not modified.
+        cached = cls.cache.get('api_json', None)
+        response = requests.get(API_JSON_URL, headers=_get_conditional_headers(cached or {}), timeout=300)
+        if response.status_code == 304 and cached:
+            return cached
         if response.status_code != 200:
             cls.logger.error('Request returned an error: {} {}.'.format(response.status_code, response.text))
-            return False
+            return None
         json_data = response.json()
 
         if not json_data.get('graphql', {}):
             cls.logger.error('Can not get Graphql API data from json')
-            return False
+            return None
         if not json_data.get('header', {}):
             cls.logger.error('Can not get header data from json')
-            return False
+            return None
 
-        cls.graphql_api_data = json_data['graphql']
-        cls.headers = json_data['header']
-        cls.init_client_transaction()
-        cls.logger.info('Pull GraphQL API data success, API number: {}'.format(len(cls.graphql_api_data)))
-        return True
+        return {
+            'etag': response.headers.get('ETag', ''),
+            'last_modified': response.headers.get('Last-Modified', ''),
+            'graphql': json_data['graphql'],
+            'header': json_data['header']
+        }
 
     @classmethod
-    def init_client_transaction(cls):
+    def _update_transaction(cls) -> dict:
+        # Returns the cached key material as is when the home page still has the same verification key and ondemand
+        # file, otherwise rebuilds it with ClientTransaction.
+        cached = cls.cache.get('transaction', None)
         session = requests.Session()
         session.headers = generate_headers()
-        home_page = session.get(url="https://x.com")
+        home_page = session.get(url=HOME_PAGE_URL, timeout=300)
+        home_page_text = home_page.text
+        key_match = SITE_VERIFICATION_REGEX.search(home_page_text)
+        ondemand_file_url = get_ondemand_file_url(response=home_page_text)
+        fingerprint = hashlib.sha256('{}\n{}'.format(
+            key_match.group(1) if key_match else home_page_text, ondemand_file_url).encode()).hexdigest()
+        if cached and cached['fingerprint'] == fingerprint:
+            return cached
+
         home_page_response = bs4.BeautifulSoup(home_page.content, 'html.parser')
-        ondemand_file_url = get_ondemand_file_url(response=home_page_response)
-        ondemand_file = session.get(url=ondemand_file_url)
+        ondemand_file = session.get(url=ondemand_file_url, timeout=300)
         ondemand_file_response = bs4.BeautifulSoup(ondemand_file.content, 'html.parser')
         try:
-            cls.ct = ClientTransaction(home_page_response=home_page_response,
-                                       ondemand_file_response=ondemand_file_response)
+            ct = ClientTransaction(home_page_response=home_page_response, ondemand_file_response=ondemand_file_response)
         except Exception:
             ondemand_file_response = ondemand_file.text
-            cls.ct = ClientTransaction(home_page_response=home_page_response,
-                                       ondemand_file_response=ondemand_file_response)
+            ct = ClientTransaction(home_page_response=home_page_response, ondemand_file_response=ondemand_file_response)
+        cls.logger.info('Client transaction key material rebuilt')
+        return {
+            'fingerprint': fingerprint,
+            'key': ct.key,
+            'animation_key': ct.animation_key,
+            'random_keyword': ct.random_keyword,
+            'random_number': ct.random_number
+        }
 
     @classmethod
     def get_clint_transaction_id(cls, method: str, url: str):
-        return cls.ct.generate_transaction_id(method=method,
-                                              path=url.replace('https://x.com', '').replace('https://twitter.com', ''))
+        return cls.snapshot.transaction_id_generator.generate(
+            method,
+            url.replace('https://x.com', '').replace('https://twitter.com', ''))
+
+    @classmethod
+    def get_headers(cls) -> dict:
+        return cls.snapshot.headers
+
+    @classmethod
+    @check_initialized
+    def has_api(cls, api_name) -> bool:
+        return api_name in cls.snapshot.graphql_api_data
 
     @classmethod
     @check_initialized
     def get_api_data(cls, api_name):
-        if api_name not in cls.graphql_api_data:
+        # Read the snapshot once, a refresh may replace it meanwhile.
+        snapshot = cls.snapshot
+        if api_name not in snapshot.graphql_api_data:
             raise ValueError('Unkonw API name: {}'.format(api_name))
 
-        api_data = cls.graphql_api_data[api_name]
-        headers = cls.headers.copy()
-        transaction_id = cls.get_clint_transaction_id(api_data['method'], api_data['url'])
-        headers['x-client-transaction-id'] = transaction_id
+        api_data = snapshot.graphql_api_data[api_name]
+        path = api_data['url'].replace('https://x.com', '').replace('https://twitter.com', '')
+        headers = snapshot.headers | {
+            'x-client-transaction-id': snapshot.transaction_id_generator.generate(api_data['method'], path)
+        }
 
         return api_data['url'], api_data['method'], headers, api_data['features']
-
-
-GraphqlAPI.init()
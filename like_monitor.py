@@ -1,34 +1,62 @@
 import time
-
-from typing import List, Union, Set
+from array import array
+from typing import Iterable, Iterator, List, Union
 
 from monitor_base import MonitorBase
-from utils import parse_media_from_tweet, parse_text_from_tweet, find_all, find_one
-
-
-def _get_like_id(like: dict) -> str:
-    return find_one(like, 'rest_id')
-
-
-def _get_like_id_set(like_list: list) -> Set[str]:
-    return set(_get_like_id(like) for like in like_list)
-
-
-def _filter_advertisers(like_list: list) -> list:
-    result = []
-    for like in like_list:
-        if find_one(like, 'card'):
-            continue
-        if find_one(like, 'userLabelType') == 'BusinessLabel':
-            continue
-        if find_one(like, '__typename') == 'TweetWithVisibilityResultss':
-            continue
-        source = find_one(like, 'source')
-        if source:
-            if 'Advertiser' in source or 'advertiser' in source:
-                continue
-        result.append(like)
-    return result
+from notifier_base import Priority
+from tweet_view import TweetView
+from utils import TIMELINE_TWEET_RESULTS
+
+
+def _filter_likes(like_list: List[TweetView]) -> List[TweetView]:
+    # Tombstones and unavailable tweets have no id.
+    return [like for like in like_list if like.rest_id is not None and not like.is_advertiser()]
+
+
+def _to_like_id(like_id: Union[str, int, None]) -> int:
+    # Returns 0, which is never a tweet id, for ids which are not numeric.
+    try:
+        return int(like_id)
+    except (TypeError, ValueError):
+        return 0
+
+
+class LikeIdCache():
+    # Insertion-ordered ring buffer of like ids stored as 64-bit ints, the oldest id is evicted when it is full.
+
+    def __init__(self, max_size: int, like_id_list: Iterable[Union[str, int]] = ()):
+        self.max_size = max_size
+        self.like_ids = array('Q', bytes(8 * max_size))
+        self.size = 0
+        self.next_index = 0
+        self.eviction_count = 0
+        for like_id in like_id_list:
+            self.add(like_id)
+
+    def __contains__(self, like_id: Union[str, int]) -> bool:
+        # Unused slots are 0, which is never a tweet id.
+        like_id = _to_like_id(like_id)
+        return like_id != 0 and like_id in self.like_ids
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[int]:
+        # From the oldest to the newest
+        if self.size < self.max_size:
+            return iter(self.like_ids[:self.size])
+        return iter(self.like_ids[self.next_index:] + self.like_ids[:self.next_index])
+
+    def add(self, like_id: Union[str, int]):
+        like_id = _to_like_id(like_id)
+        if like_id == 0:
+            return
+        if self.size == self.max_size:
+            self.eviction_count += 1
+        else:
+            self.size += 1
+        self.like_ids[self.next_index] = like_id
+        self.next_index = (self.next_index + 1) % self.max_size
 
 
 class LikeMonitor(MonitorBase):
@@ -43,22 +71,29 @@ class LikeMonitor(MonitorBase):
                          user_config=user_config,
                          cookies_dir=cookies_dir)
 
-        like_list = self.get_like_list()
-        while like_list is None:
-            time.sleep(60)
+        checkpoint = self.load_checkpoint()
+        if checkpoint:
+            self.existing_like_id_cache = LikeIdCache(self.like_id_set_max_size, checkpoint['existing_like_id_list'])
+        else:
             like_list = self.get_like_list()
-        self.existing_like_id_set = _get_like_id_set(like_list)
+            while like_list is None:
+                time.sleep(60)
+                like_list = self.get_like_list()
+            # The like list is from the newest to the oldest
+            self.existing_like_id_cache = LikeIdCache(self.like_id_set_max_size,
+                                                      reversed([like.rest_id for like in like_list]))
+            self.save_checkpoint()
 
         self.logger.info('Init like monitor succeed.\nUser id: {}\nExisting {} likes: {}'.format(
-            self.user_id, len(self.existing_like_id_set), self.existing_like_id_set))
+            self.user_id, len(self.existing_like_id_cache), list(self.existing_like_id_cache)))
 
-    def get_like_list(self) -> Union[list, None]:
+    def get_like_list(self) -> Union[List[TweetView], None]:
         api_name = 'Likes'
         params = {'userId': self.user_id, 'includePromotedContent': True, 'count': 1000}
         json_response = self.twitter_watcher.query(api_name, params)
         if json_response is None:
             return None
-        return _filter_advertisers(find_all(json_response, 'tweet_results'))
+        return _filter_likes([TweetView(like) for like in TIMELINE_TWEET_RESULTS.extract_all(json_response)])
 
     def watch(self) -> bool:
         like_list = self.get_like_list()
@@ -67,21 +102,24 @@ class LikeMonitor(MonitorBase):
 
         new_like_list = []
         for like in like_list:
-            like_id = _get_like_id(like)
-            if like_id in self.existing_like_id_set:
+            if like.rest_id in self.existing_like_id_cache:
                 break
-            self.existing_like_id_set.add(like_id)
             new_like_list.append(like)
 
         for like in reversed(new_like_list):
-            photo_url_list, video_url_list = parse_media_from_tweet(like)
-            text = parse_text_from_tweet(like)
-            user = find_one(like, 'user_results')
-            username = find_one(user, 'screen_name')
-            self.send_message('@{}: {}'.format(username, text), photo_url_list, video_url_list)
+            self.existing_like_id_cache.add(like.rest_id)
+            self.send_message('@{}: {}'.format(like.screen_name, like.text),
+                              like.photo_url_list,
+                              like.video_url_list,
+                              priority=Priority.BULK)
 
         self.update_last_watch_time()
+        self.save_checkpoint()
         return True
 
     def status(self) -> str:
-        return 'Last: {}, num: {}'.format(self.get_last_watch_time(), len(self.existing_like_id_set))
+        return 'Last: {}, num: {}, evicted: {}'.format(self.get_last_watch_time(), len(self.existing_like_id_cache),
+                                                       self.existing_like_id_cache.eviction_count)
+
+    def get_checkpoint(self) -> dict:
+        return {'existing_like_id_list': list(self.existing_like_id_cache)}
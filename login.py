@@ -186,13 +186,14 @@ def execute_login_flow(client: Client, confirmation_code, **kwargs) -> Client:
 
 
 def login(username: str, password: str, confirmation_code: str = None, **kwargs) -> Client:
+    GraphqlAPI.init()
     client = Client(cookies={
         "username": username,
         "password": password,
         "guest_token": None,
         "flow_token": None,
     },
-                    headers=GraphqlAPI.headers | {
+                    headers=GraphqlAPI.get_headers() | {
                         'content-type': 'application/json',
                         'x-twitter-active-user': 'yes',
                         'x-twitter-client-language': 'en',
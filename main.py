@@ -1,26 +1,39 @@
 #!/usr/bin/python3
 
+import time
+
+# Taken before the other imports, for the startup report.
+START_TIME = time.perf_counter()
+
+import asyncio
+import concurrent.futures
 import json
 import logging
 import os
 import sys
+from typing import Union
 
 import click
+from apscheduler.events import EVENT_JOB_EXECUTED
 from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.schedulers.background import BlockingScheduler
 
+from adaptive_polling import AdaptivePollingScheduler
+from checkpoint_store import CheckpointStore
 from cqhttp_notifier import CqhttpNotifier
 from discord_notifier import DiscordNotifier
 from following_monitor import FollowingMonitor
 from graphql_api import GraphqlAPI
 from like_monitor import LikeMonitor
 from login import login
+from metrics import Metrics
 from monitor_base import MonitorManager
-from profile_monitor import ProfileMonitor
+from profile_monitor import ProfileBatchWatcher, ProfileMonitor
 from status_tracker import StatusTracker
 from telegram_notifier import TelegramMessage, TelegramNotifier, send_alert
 from tweet_monitor import TweetMonitor
-from twitter_watcher import TwitterWatcher
+from twitter_watcher import TwitterWatcher, TwitterWatcherManager
 
 CONFIG_FIELD_TO_MONITOR = {
     'monitoring_profile': ProfileMonitor,
@@ -29,6 +42,8 @@ CONFIG_FIELD_TO_MONITOR = {
     'monitoring_tweet': TweetMonitor
 }
 
+IMPORT_TIME = time.perf_counter() - START_TIME
+
 
 def _setup_logger(name: str, log_file_path: str, level=logging.INFO):
     file_handler = logging.FileHandler(log_file_path)
@@ -38,7 +53,10 @@ def _setup_logger(name: str, log_file_path: str, level=logging.INFO):
     logger.addHandler(file_handler)
 
 
-def _send_summary(telegram_chat_id: str, monitors: dict, watcher: TwitterWatcher):
+def _send_summary(telegram_chat_id: str,
+                  monitors: dict,
+                  watcher: TwitterWatcher,
+                  polling_scheduler: Union[AdaptivePollingScheduler, None] = None):
     for modoule, data in monitors.items():
         monitor_status = {}
         for username, monitor in data.items():
@@ -46,10 +64,43 @@ def _send_summary(telegram_chat_id: str, monitors: dict, watcher: TwitterWatcher
         TelegramNotifier.put_message_into_queue(
             TelegramMessage(chat_id_list=[telegram_chat_id],
                             text='{}: {}'.format(modoule, json.dumps(monitor_status, indent=4))))
+    if polling_scheduler:
+        TelegramNotifier.put_message_into_queue(
+            TelegramMessage(chat_id_list=[telegram_chat_id],
+                            text='Polling intervals: {}'.format(json.dumps(polling_scheduler.status(), indent=4))))
     tokens_status = watcher.check_tokens()
     TelegramNotifier.put_message_into_queue(
         TelegramMessage(chat_id_list=[telegram_chat_id],
                         text='Tokens status: {}'.format(json.dumps(tokens_status, indent=4))))
+    TelegramNotifier.put_message_into_queue(
+        TelegramMessage(chat_id_list=[telegram_chat_id],
+                        text='Rate limit remaining: {}'.format(json.dumps(watcher.token_budget.status(), indent=4))))
+    TelegramNotifier.put_message_into_queue(
+        TelegramMessage(chat_id_list=[telegram_chat_id],
+                        text='Query cache: {}'.format(json.dumps(watcher.query_cache.status(), indent=4))))
+    TelegramNotifier.put_message_into_queue(
+        TelegramMessage(chat_id_list=[telegram_chat_id],
+                        text='Delivery latency: {}'.format(json.dumps(StatusTracker.get_delivery_latency(), indent=4))))
+    TelegramNotifier.put_message_into_queue(
+        TelegramMessage(chat_id_list=[telegram_chat_id],
+                        text='Queue status: {}'.format(json.dumps(StatusTracker.get_queue_status(), indent=4))))
+    outbox_status = {
+        notifier.notifier_name: notifier.outbox.status()
+        for notifier in (TelegramNotifier, CqhttpNotifier, DiscordNotifier)
+        if notifier.initialized and notifier.outbox
+    }
+    if outbox_status:
+        TelegramNotifier.put_message_into_queue(
+            TelegramMessage(chat_id_list=[telegram_chat_id],
+                            text='Outbox: {}'.format(json.dumps(outbox_status, indent=4))))
+    TelegramNotifier.put_message_into_queue(
+        TelegramMessage(chat_id_list=[telegram_chat_id],
+                        text='Telegram file id cache: {}'.format(
+                            json.dumps(TelegramNotifier.file_id_cache.status(), indent=4))))
+    TelegramNotifier.put_message_into_queue(
+        TelegramMessage(chat_id_list=[telegram_chat_id],
+                        text='Connection pool: {}'.format(json.dumps(TwitterWatcherManager.get_pool_stats(),
+                                                                     indent=4))))
 
 
 def _check_monitors_status(telegram_token: str, telegram_chat_id: int, monitors: dict):
@@ -70,6 +121,70 @@ def _check_tokens_status(telegram_token: str, telegram_chat_id: int, watcher: Tw
                    message='Some tokens failed: {}'.format(json.dumps(tokens_status, indent=4)))
 
 
+def _build_monitors(monitoring_user_list: list, token_config: dict, cookies_dir: str, log_dir: str,
+                    startup_workers: int) -> dict:
+    logger = logging.getLogger('startup')
+    twitter_watcher = TwitterWatcherManager.get(token_config.get('twitter_auth_username_list', []), cookies_dir)
+    startup_time = time.perf_counter()
+
+    # Phase 1: resolve each username to user id once, monitors reuse the cached id.
+    username_list = list(dict.fromkeys(monitoring_user['username'] for monitoring_user in monitoring_user_list))
+    for username in username_list:
+        user_id = CheckpointStore.get_user_id(username)
+        if user_id:
+            twitter_watcher.user_id_cache[username] = user_id
+    with concurrent.futures.ThreadPoolExecutor(max_workers=startup_workers) as executor:
+        list(executor.map(twitter_watcher.get_id_by_username, username_list))
+    resolve_time = time.perf_counter() - startup_time
+
+    # Phase 2: build every monitor independently, so one slow account does not hold up the others.
+    def _build_monitor(monitor_cls, monitoring_user: dict):
+        build_start_time = time.perf_counter()
+        username = monitoring_user['username']
+        monitor = monitor_cls(username, monitoring_user.get('title', username), token_config, monitoring_user,
+                              cookies_dir)
+        return monitor, time.perf_counter() - build_start_time
+
+    monitors = dict()
+    build_time = dict()
+    futures = []
+    for monitor_cls in CONFIG_FIELD_TO_MONITOR.values():
+        monitors[monitor_cls.monitor_type] = dict()
+        build_time[monitor_cls.monitor_type] = []
+    build_start_time = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=startup_workers) as executor:
+        for monitoring_user in monitoring_user_list:
+            title = monitoring_user.get('title', monitoring_user['username'])
+            for config_field, monitor_cls in CONFIG_FIELD_TO_MONITOR.items():
+                if monitoring_user.get(config_field, False) or monitor_cls is ProfileMonitor:
+                    logger_name = '{}-{}'.format(title, monitor_cls.monitor_type)
+                    _setup_logger(logger_name, os.path.join(log_dir, logger_name))
+                    futures.append((monitor_cls, title, executor.submit(_build_monitor, monitor_cls, monitoring_user)))
+        for monitor_cls, title, future in futures:
+            monitor, cost = future.result()
+            monitors[monitor_cls.monitor_type][title] = monitor
+            build_time[monitor_cls.monitor_type].append(cost)
+
+    # Cold-started following monitors can not read the profile yet, take the following count of the profile built
+    # meanwhile as the baseline of the incremental diff, instead of a full reconcile on the first change.
+    for title, following_monitor in monitors[FollowingMonitor.monitor_type].items():
+        profile_monitor = monitors[ProfileMonitor.monitor_type].get(title, None)
+        if following_monitor.following_count is None and profile_monitor:
+            following_monitor.following_count = profile_monitor.following_count.element
+            following_monitor.save_checkpoint()
+
+    report = ['Startup finished in {:.1f}s'.format(time.perf_counter() - startup_time)]
+    report.append('Resolve {} user ids: {:.1f}s'.format(len(username_list), resolve_time))
+    report.append('Build monitors: {:.1f}s'.format(time.perf_counter() - build_start_time))
+    for monitor_type, cost_list in build_time.items():
+        if cost_list:
+            report.append('  {}: {} monitors, total {:.1f}s, max {:.1f}s'.format(monitor_type, len(cost_list),
+                                                                                 sum(cost_list), max(cost_list)))
+    logger.info('\n'.join(report))
+    print('\n'.join(report))
+    return monitors
+
+
 @click.group()
 def cli():
     pass
@@ -87,14 +202,61 @@ def cli():
               default=False,
               help="Liten the \"exit\" command from telegram maintainer chat id")
 @click.option('--send_daily_summary', is_flag=True, default=False, help="Send daily summary to telegram maintainer")
+@click.option('--engine',
+              type=click.Choice(['thread', 'asyncio']),
+              default='thread',
+              help="Run profile polling in a thread pool, or as coroutines on one event loop")
+@click.option('--max_concurrency', default=100, help="Max concurrent requests of the asyncio engine")
+@click.option('--startup_workers', default=8, help="Number of monitors initialized concurrently at startup")
+@click.option('--checkpoint_path',
+              default=os.path.join(sys.path[0], 'checkpoint.db'),
+              help="Monitor state checkpoint file for warm restarts, empty to disable")
+@click.option('--profile_batch_size',
+              default=0,
+              help="Fetch profiles of this many users per request with the bulk API, 0 to disable")
+@click.option('--adaptive_polling',
+              is_flag=True,
+              default=False,
+              help="Poll active users more often and dormant users less, starting from --interval")
+@click.option('--min_interval', default=5.0, help="Min profile polling interval of adaptive polling")
+@click.option('--max_interval', default=300.0, help="Max profile polling interval of adaptive polling")
+@click.option('--poll_budget_per_token',
+              default=0.08,
+              help="Profile polling requests per second allowed per token of adaptive polling, 0 for no limit. "
+              "--max_interval takes precedence")
+@click.option('--telegram_concurrency', default=4, help="Number of telegram delivery workers")
+@click.option('--cqhttp_concurrency', default=4, help="Number of cqhttp delivery workers")
+@click.option('--discord_concurrency', default=4, help="Number of discord delivery workers")
+@click.option('--telegram_file_id_cache_path',
+              default=os.path.join(sys.path[0], 'telegram_file_id.json'),
+              help="Cache file of the telegram file ids of sent media, empty to keep it in memory only")
+@click.option('--outbox_dir',
+              default=os.path.join(sys.path[0], 'outbox'),
+              help="Directory of the journals of queued messages replayed after a restart, empty to disable")
+@click.option('--queue_capacity',
+              default=1000,
+              help="Max queued messages per notifier destination, the lowest priority ones are dropped when full")
+@click.option('--coalesce_window',
+              default=2.0,
+              help="Merge messages to the same destination within this many seconds into digests, 0 to disable")
+@click.option('--metrics_port', default=0, help="Serve prometheus metrics at localhost:port/metrics, 0 to disable")
+@click.option('--graphql_api_cache_path',
+              default=os.path.join(sys.path[0], 'graphql_api_cache.json'),
+              help="Cache file of the GraphQL API data to start without waiting for the network, empty to disable")
 def run(log_dir, cookies_dir, token_config_path, monitoring_config_path, interval, confirm, listen_exit_command,
-        send_daily_summary):
+        send_daily_summary, engine, max_concurrency, startup_workers, checkpoint_path, profile_batch_size,
+        adaptive_polling, min_interval, max_interval, poll_budget_per_token, telegram_concurrency, cqhttp_concurrency,
+        discord_concurrency, telegram_file_id_cache_path, outbox_dir, queue_capacity, coalesce_window, metrics_port,
+        graphql_api_cache_path):
     os.makedirs(log_dir, exist_ok=True)
     logging.basicConfig(filename=os.path.join(log_dir, 'main'),
                         format='%(asctime)s - %(levelname)s - %(message)s',
                         level=logging.WARNING)
     _setup_logger('api', os.path.join(log_dir, 'twitter-api'))
     _setup_logger('status', os.path.join(log_dir, 'status-tracker'))
+    if metrics_port:
+        _setup_logger('metrics', os.path.join(log_dir, 'metrics'))
+        Metrics.init(port=metrics_port)
 
     with open(os.path.join(token_config_path), 'r') as token_config_file:
         token_config = json.load(token_config_file)
@@ -108,36 +270,85 @@ def run(log_dir, cookies_dir, token_config_path, monitoring_config_path, interva
     _setup_logger('telegram', os.path.join(log_dir, 'telegram'))
     _setup_logger('cqhttp', os.path.join(log_dir, 'cqhttp'))
     _setup_logger('discord', os.path.join(log_dir, 'discord'))
-    TelegramNotifier.init(token=telegram_bot_token, logger_name='telegram')
-    CqhttpNotifier.init(token=token_config.get('cqhttp_access_token', ''), logger_name='cqhttp')
-    DiscordNotifier.init(logger_name='discord')
+    if outbox_dir:
+        os.makedirs(outbox_dir, exist_ok=True)
+    TelegramNotifier.init(token=telegram_bot_token,
+                          logger_name='telegram',
+                          concurrency=telegram_concurrency,
+                          coalesce_window=coalesce_window,
+                          file_id_cache_path=telegram_file_id_cache_path,
+                          outbox_dir=outbox_dir,
+                          queue_capacity=queue_capacity)
+    CqhttpNotifier.init(token=token_config.get('cqhttp_access_token', ''),
+                        logger_name='cqhttp',
+                        concurrency=cqhttp_concurrency,
+                        coalesce_window=coalesce_window,
+                        outbox_dir=outbox_dir,
+                        queue_capacity=queue_capacity)
+    DiscordNotifier.init(logger_name='discord',
+                         concurrency=discord_concurrency,
+                         coalesce_window=coalesce_window,
+                         outbox_dir=outbox_dir,
+                         queue_capacity=queue_capacity)
 
-    monitors = dict()
-    for monitor_cls in CONFIG_FIELD_TO_MONITOR.values():
-        monitors[monitor_cls.monitor_type] = dict()
-    executors = {'default': ThreadPoolExecutor(len(monitoring_config['monitoring_user_list']))}
-    scheduler = BlockingScheduler(executors=executors)
-    for monitoring_user in monitoring_config['monitoring_user_list']:
-        username = monitoring_user['username']
-        title = monitoring_user.get('title', username)
-        for config_field, monitor_cls in CONFIG_FIELD_TO_MONITOR.items():
-            if monitoring_user.get(config_field, False) or monitor_cls is ProfileMonitor:
-                monitor_type = monitor_cls.monitor_type
-                logger_name = '{}-{}'.format(title, monitor_type)
-                _setup_logger(logger_name, os.path.join(log_dir, logger_name))
-                monitors[monitor_type][title] = monitor_cls(username, title, token_config, monitoring_user, cookies_dir)
-                if monitor_cls is ProfileMonitor:
-                    scheduler.add_job(monitors[monitor_type][title].watch, trigger='interval', seconds=interval)
+    TwitterWatcherManager.init(pool_maxsize=len(monitoring_config['monitoring_user_list']))
+    _setup_logger('startup', os.path.join(log_dir, 'startup'))
+    api_init_start_time = time.perf_counter()
+    GraphqlAPI.init(cache_path=graphql_api_cache_path)
+    report = 'Import: {:.2f}s, GraphQL API init: {:.2f}s'.format(IMPORT_TIME, time.perf_counter() - api_init_start_time)
+    logging.getLogger('startup').info(report)
+    print(report)
+    if checkpoint_path:
+        _setup_logger('checkpoint', os.path.join(log_dir, 'checkpoint'))
+        CheckpointStore.init(checkpoint_path)
+    monitors = _build_monitors(monitoring_config['monitoring_user_list'], token_config, cookies_dir, log_dir,
+                               startup_workers)
+    if engine == 'asyncio':
+        TwitterWatcherManager.init_async(max_concurrency=max_concurrency)
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+        scheduler = AsyncIOScheduler(event_loop=event_loop)
+    else:
+        executors = {'default': ThreadPoolExecutor(len(monitoring_config['monitoring_user_list']))}
+        scheduler = BlockingScheduler(executors=executors)
+    polling_scheduler = None
+    if adaptive_polling:
+        _setup_logger('profile-batch', os.path.join(log_dir, 'profile-batch'))
+        _setup_logger('adaptive-polling', os.path.join(log_dir, 'adaptive-polling'))
+        batch_watcher = ProfileBatchWatcher(list(monitors[ProfileMonitor.monitor_type].values()), profile_batch_size)
+        polling_scheduler = AdaptivePollingScheduler(batch_watcher, interval, min_interval, max_interval,
+                                                     poll_budget_per_token * len(twitter_auth_username_list))
+        tick = polling_scheduler.tick_async if engine == 'asyncio' else polling_scheduler.tick
+        scheduler.add_job(tick, trigger='interval', seconds=1)
+    elif profile_batch_size > 0:
+        _setup_logger('profile-batch', os.path.join(log_dir, 'profile-batch'))
+        batch_watcher = ProfileBatchWatcher(list(monitors[ProfileMonitor.monitor_type].values()), profile_batch_size)
+        watch = batch_watcher.watch_async if engine == 'asyncio' else batch_watcher.watch
+        scheduler.add_job(watch, trigger='interval', seconds=interval)
+    else:
+        for monitor in monitors[ProfileMonitor.monitor_type].values():
+            watch = monitor.watch_async if engine == 'asyncio' else monitor.watch
+            scheduler.add_job(watch, trigger='interval', seconds=interval)
     _setup_logger('monitor-caller', os.path.join(log_dir, 'monitor-caller'))
     MonitorManager.init(monitors=monitors)
 
     scheduler.add_job(GraphqlAPI.update_api_data, trigger='cron', hour='*')
 
+    def _report_first_poll(event):
+        if not any(monitor.watch_count for monitor in monitors[ProfileMonitor.monitor_type].values()):
+            return
+        scheduler.remove_listener(_report_first_poll)
+        report = 'First successful poll {:.1f}s after start'.format(time.perf_counter() - START_TIME)
+        logging.getLogger('startup').info(report)
+        print(report)
+
+    scheduler.add_listener(_report_first_poll, EVENT_JOB_EXECUTED)
+
     if monitoring_config['maintainer_chat_id']:
         # maintainer_chat_id should be telegram chat id.
         maintainer_chat_id = monitoring_config['maintainer_chat_id']
-        twitter_watcher = TwitterWatcher(twitter_auth_username_list, cookies_dir)
-        _send_summary(maintainer_chat_id, monitors, twitter_watcher)
+        twitter_watcher = TwitterWatcherManager.get(twitter_auth_username_list, cookies_dir)
+        _send_summary(maintainer_chat_id, monitors, twitter_watcher, polling_scheduler)
         scheduler.add_job(_check_monitors_status,
                           trigger='cron',
                           hour='*',
@@ -150,7 +361,7 @@ def run(log_dir, cookies_dir, token_config_path, monitoring_config_path, interva
             scheduler.add_job(_send_summary,
                               trigger='cron',
                               hour='6',
-                              args=[maintainer_chat_id, monitors, twitter_watcher])
+                              args=[maintainer_chat_id, monitors, twitter_watcher, polling_scheduler])
         if confirm:
             if not TelegramNotifier.confirm(
                     TelegramMessage(chat_id_list=[maintainer_chat_id],
@@ -164,6 +375,8 @@ def run(log_dir, cookies_dir, token_config_path, monitoring_config_path, interva
             TelegramNotifier.listen_exit_command(maintainer_chat_id)
 
     scheduler.start()
+    if engine == 'asyncio':
+        event_loop.run_forever()
 
 
 @cli.command(context_settings={'show_default': True})
@@ -178,7 +391,8 @@ def check_tokens(cookies_dir, token_config_path, telegram_chat_id, test_username
         telegram_bot_token = token_config.get('telegram_bot_token', '')
         twitter_auth_username_list = token_config.get('twitter_auth_username_list', [])
         assert twitter_auth_username_list
-    twitter_watcher = TwitterWatcher(twitter_auth_username_list, cookies_dir)
+    GraphqlAPI.init()
+    twitter_watcher = TwitterWatcherManager.get(twitter_auth_username_list, cookies_dir)
     result = json.dumps(twitter_watcher.check_tokens(test_username, output_response), indent=4)
     print(result)
     if telegram_chat_id:
@@ -0,0 +1,142 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# name: (type, help)
+METRIC_DESCRIPTIONS = {
+    'twitter_api_request_duration_seconds': ('histogram', 'Twitter api request latency by endpoint'),
+    'twitter_api_responses_total': ('counter', 'Twitter api responses by endpoint and status code'),
+    'twitter_token_requests_total': ('counter', 'Twitter api requests by token and result'),
+    'twitter_query_cache_total': ('counter', 'Twitter api queries by endpoint and cache hit, merged or miss'),
+    'monitor_watch_duration_seconds': ('histogram', 'Duration of a monitor watch by monitor type'),
+    'notifier_send_duration_seconds': ('histogram', 'Duration of sending a message by notifier and destination'),
+    'notifier_queue_depth': ('gauge', 'Queued messages by notifier and destination'),
+    'notifier_dropped_messages_total': ('counter', 'Messages dropped by full queues by notifier and destination'),
+    'profile_poll_interval_seconds': ('gauge', 'Adaptive polling interval by user'),
+    'notify_lag_seconds': ('histogram', 'From the poll which finds an event to its message being sent, by notifier'),
+}
+
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(key,
+                         str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels))
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics():
+    # Metrics in the prometheus text format, served by a local http endpoint. Nothing is recorded before init.
+    initialized = False
+
+    def __new__(cls):
+        raise Exception('Do not instantiate this class!')
+
+    @classmethod
+    def init(cls, port: int, host: str = '127.0.0.1'):
+        cls.logger = logging.getLogger('metrics')
+        cls.lock = threading.Lock()
+        cls.counters = dict()
+        cls.gauges = dict()
+        # (name, labels): [count of each bucket, count of +Inf, sum]
+        cls.histograms = dict()
+
+        class _Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = Metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        cls.server = ThreadingHTTPServer((host, port), _Handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.initialized = True
+        cls.logger.info('Serve metrics at http://{}:{}/metrics'.format(host, port))
+
+    @classmethod
+    def inc(cls, name: str, value: float = 1, **labels):
+        if not cls.initialized:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with cls.lock:
+            cls.counters[key] = cls.counters.get(key, 0) + value
+
+    @classmethod
+    def set(cls, name: str, value: float, **labels):
+        if not cls.initialized:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with cls.lock:
+            cls.gauges[key] = value
+
+    @classmethod
+    def observe(cls, name: str, value: float, **labels):
+        if not cls.initialized:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(HISTOGRAM_BUCKETS, value)
+        with cls.lock:
+            histogram = cls.histograms.get(key, None)
+            if histogram is None:
+                histogram = cls.histograms[key] = [0] * (len(HISTOGRAM_BUCKETS) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += value
+
+    @classmethod
+    @contextmanager
+    def timer(cls, name: str, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.observe(name, time.perf_counter() - start_time, **labels)
+
+    @classmethod
+    def render(cls) -> str:
+        with cls.lock:
+            counters = sorted(cls.counters.items())
+            gauges = sorted(cls.gauges.items())
+            histograms = sorted((key, list(histogram)) for key, histogram in cls.histograms.items())
+        lines = []
+        described = set()
+
+        def _describe(name: str):
+            if name in described:
+                return
+            described.add(name)
+            metric_type, metric_help = METRIC_DESCRIPTIONS.get(name, ('untyped', name))
+            lines.append('# HELP {} {}'.format(name, metric_help))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+
+        for (name, labels), value in counters + gauges:
+            _describe(name)
+            lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        for (name, labels), histogram in histograms:
+            _describe(name)
+            cumulative_count = 0
+            for bucket, count in zip(HISTOGRAM_BUCKETS + ('+Inf',), histogram[:-1]):
+                cumulative_count += count
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', bucket),)),
+                                                     cumulative_count))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(histogram[-1])))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), cumulative_count))
+        return '\n'.join(lines) + '\n'
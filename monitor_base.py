@@ -1,12 +1,16 @@
 import logging
+import time
 from abc import ABC, abstractmethod
 from typing import List, Union
 
+from checkpoint_store import CheckpointStore
 from cqhttp_notifier import CqhttpMessage, CqhttpNotifier
 from discord_notifier import DiscordMessage, DiscordNotifier
+from metrics import Metrics
+from notifier_base import Priority
 from status_tracker import StatusTracker
 from telegram_notifier import TelegramMessage, TelegramNotifier
-from twitter_watcher import TwitterWatcher
+from twitter_watcher import TwitterWatcherManager
 
 
 class MonitorBase(ABC):
@@ -15,8 +19,11 @@ class MonitorBase(ABC):
                  cookies_dir: str):
         logger_name = '{}-{}'.format(title, monitor_type)
         self.logger = logging.getLogger(logger_name)
-        self.twitter_watcher = TwitterWatcher(token_config.get('twitter_auth_username_list', []), cookies_dir)
+        self.twitter_watcher = TwitterWatcherManager.get(token_config.get('twitter_auth_username_list', []),
+                                                         cookies_dir)
         self.username = username
+        self.original_username = username
+        self.title = title
         self.user_id = self.twitter_watcher.get_id_by_username(username)
         if not self.user_id:
             raise RuntimeError('Initialization error, please check if username {} exists'.format(username))
@@ -24,6 +31,8 @@ class MonitorBase(ABC):
         self.cqhttp_url_list = user_config.get('cqhttp_url_list', None)
         self.discord_webhook_url_list = user_config.get('discord_webhook_url_list', None)
         self.message_prefix = '[{}][{}]'.format(username, monitor_type)
+        # Time of the latest poll, set by the caller of watch.
+        self.poll_time = None
         self.update_last_watch_time()
 
     def update_last_watch_time(self):
@@ -32,10 +41,18 @@ class MonitorBase(ABC):
     def get_last_watch_time(self):
         return StatusTracker.get_monitor_status(self.monitor_type, self.username)
 
+    def load_checkpoint(self) -> Union[dict, None]:
+        # Only read by the constructors, the restored state is not kept around twice.
+        return CheckpointStore.load(self.monitor_type, self.title, self.original_username)
+
+    def save_checkpoint(self):
+        CheckpointStore.save(self.monitor_type, self.title, self.original_username, self.user_id, self.get_checkpoint())
+
     def send_message(self,
                      message: str,
                      photo_url_list: Union[List[str], None] = None,
-                     video_url_list: Union[List[str], None] = None):
+                     video_url_list: Union[List[str], None] = None,
+                     priority: Priority = Priority.NORMAL):
         message = '{} {}'.format(self.message_prefix, message)
         self.logger.info('Sending message: {}\n'.format(message))
         if photo_url_list:
@@ -46,24 +63,31 @@ class MonitorBase(ABC):
             self.logger.info('Photo: {}'.format(', '.join(photo_url_list)))
         if video_url_list:
             self.logger.info('Video: {}'.format(', '.join(video_url_list)))
+        notifier_message_list = []
         if self.telegram_chat_id_list:
-            TelegramNotifier.put_message_into_queue(
-                TelegramMessage(chat_id_list=self.telegram_chat_id_list,
-                                text=message,
-                                photo_url_list=photo_url_list,
-                                video_url_list=video_url_list))
+            notifier_message_list.append((TelegramNotifier,
+                                          TelegramMessage(chat_id_list=self.telegram_chat_id_list,
+                                                          text=message,
+                                                          photo_url_list=photo_url_list,
+                                                          video_url_list=video_url_list,
+                                                          priority=priority)))
         if self.cqhttp_url_list:
-            CqhttpNotifier.put_message_into_queue(
-                CqhttpMessage(url_list=self.cqhttp_url_list,
-                              text=message,
-                              photo_url_list=photo_url_list,
-                              video_url_list=video_url_list))
+            notifier_message_list.append((CqhttpNotifier,
+                                          CqhttpMessage(url_list=self.cqhttp_url_list,
+                                                        text=message,
+                                                        photo_url_list=photo_url_list,
+                                                        video_url_list=video_url_list,
+                                                        priority=priority)))
         if self.discord_webhook_url_list:
-            DiscordNotifier.put_message_into_queue(
-                DiscordMessage(webhook_url_list=self.discord_webhook_url_list,
-                               text=message,
-                               photo_url_list=photo_url_list,
-                               video_url_list=video_url_list))
+            notifier_message_list.append((DiscordNotifier,
+                                          DiscordMessage(webhook_url_list=self.discord_webhook_url_list,
+                                                         text=message,
+                                                         photo_url_list=photo_url_list,
+                                                         video_url_list=video_url_list,
+                                                         priority=priority)))
+        for notifier, notifier_message in notifier_message_list:
+            notifier_message.poll_time = self.poll_time
+            notifier.put_message_into_queue(notifier_message)
 
     @abstractmethod
     def watch(self) -> bool:
@@ -73,6 +97,10 @@ class MonitorBase(ABC):
     def status(self) -> str:
         pass
 
+    @abstractmethod
+    def get_checkpoint(self) -> dict:
+        pass
+
 
 class MonitorManager():
     monitors = None
@@ -98,4 +126,6 @@ class MonitorManager():
         monitor = cls.get(monitor_type, username)
         if not monitor:
             return True
-        return monitor.watch()
+        monitor.poll_time = time.time()
+        with Metrics.timer('monitor_watch_duration_seconds', monitor_type=monitor_type):
+            return monitor.watch()
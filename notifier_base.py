@@ -1,62 +1,301 @@
+import heapq
+import itertools
+import os
 import queue
 import threading
+import time
 from abc import ABC, abstractmethod
-from typing import List, Union
+from collections import deque
+from enum import IntEnum
+from typing import List, Tuple, Union
 
+from metrics import Metrics
+from outbox import Outbox
 from status_tracker import StatusTracker
 from utils import check_initialized
 
 
+class Priority(IntEnum):
+    # Queued messages of a higher priority (smaller value) are sent first.
+    ALERT = 0
+    NORMAL = 1
+    BULK = 2
+
+
 class Message:
 
     def __init__(self,
                  text: str,
                  photo_url_list: Union[List[str], None] = None,
-                 video_url_list: Union[List[str], None] = None):
+                 video_url_list: Union[List[str], None] = None,
+                 priority: Priority = Priority.NORMAL):
         self.text = text
         self.photo_url_list = photo_url_list
         self.video_url_list = video_url_list
+        self.priority = priority
+        # Time of the poll which finds the event, for the poll-to-notify lag.
+        self.poll_time = None
 
 
 class NotifierBase(ABC):
     initialized = False
+    # Limits of a digest message merged from a burst of messages, None means no limit.
+    digest_text_limit = None
+    digest_caption_limit = None
+    digest_media_limit = None
+    digest_merge_video = True
+    # A message which fails to send is retried with exponential backoff, then put into the dead letter file.
+    max_send_tries = 3
+    send_retry_delay = 5
 
     def __new__(self):
         raise Exception('Do not instantiate this class!')
 
     @classmethod
     @abstractmethod
-    def init(cls):
-        cls.message_queue = queue.SimpleQueue()
+    def init(cls, concurrency: int = 1, coalesce_window: float = 0, outbox_dir: str = '', queue_capacity: int = 1000):
+        # Messages are queued per destination. A worker takes a destination which is not being served by
+        # another worker, so that each destination keeps its order while different destinations are delivered
+        # in parallel, and a slow destination can only hold up one worker.
+        # A destination becomes ready coalesce_window seconds after its first pending message, and the
+        # messages queued by then are merged into digests.
+        # With an outbox, queued messages are journaled on disk until delivered and replayed after a restart.
+        # Each destination queues at most queue_capacity messages. When it is full, the oldest message of the
+        # lowest priority is dropped, or the new message if all the queued messages have a higher priority.
+        cls.destination_queues = dict()
+        cls.ready_destinations = queue.SimpleQueue()
+        cls.scheduled_destinations = set()
+        cls.destination_lock = threading.Lock()
+        cls.concurrency = max(concurrency, 1)
+        cls.coalesce_window = max(coalesce_window, 0)
+        cls.delayed_destinations = []
+        cls.delayed_destination_seq = itertools.count()
+        cls.delayed_destination_condition = threading.Condition()
+        cls.coalesced_message_count = 0
+        cls.queue_capacity = max(queue_capacity, 1)
+        cls.outbox = Outbox(os.path.join(outbox_dir, '{}.jsonl'.format(cls.notifier_name.lower())),
+                            cls.logger.name) if outbox_dir else None
         StatusTracker.set_notifier_status(cls.notifier_name, True)
         cls.initialized = True
+        if cls.outbox:
+            for entry_id, destination, text, photo_url_list, video_url_list, priority in cls.outbox.get_unacked():
+                message = cls.build_message(destination, text, photo_url_list, video_url_list)
+                message.priority = Priority(priority)
+                cls._put_into_destination_queue(destination, message, entry_id)
         cls.work_start()
 
     @classmethod
     @abstractmethod
+    def get_destination_list(cls, message: Message) -> list:
+        pass
+
+    @classmethod
+    @abstractmethod
+    def send_message_to_destination(cls, destination, message: Message):
+        pass
+
+    @classmethod
+    def get_destination_name(cls, destination) -> str:
+        # Used in status reports, override it to hide secrets in the destination.
+        return str(destination)
+
+    @classmethod
+    def build_message(cls, destination, text: str, photo_url_list: Union[List[str], None],
+                      video_url_list: Union[List[str], None]) -> Message:
+        # Build a digest message sent to the destination, override it to use the notifier's message class.
+        return Message(text, photo_url_list, video_url_list)
+
+    @classmethod
+    def _exceed_digest_limit(cls, text: str, media_count: int) -> bool:
+        text_limit = cls.digest_caption_limit if media_count else cls.digest_text_limit
+        if text_limit is not None and len(text) > text_limit:
+            return True
+        return cls.digest_media_limit is not None and media_count > cls.digest_media_limit
+
+    @classmethod
+    def merge_messages(cls, destination, message_list: List[Message]) -> List[Tuple[Message, int]]:
+        # Merge consecutive messages into as few digests as the notifier limits allow, keeping the order.
+        # Returns the digests with the number of messages merged into each of them.
+        if len(message_list) <= 1:
+            return [(message, 1) for message in message_list]
+        result = []
+        pending = []
+        text, photo_url_list, video_url_list = '', [], []
+
+        def _flush():
+            if len(pending) == 1:
+                result.append((pending[0], 1))
+            elif pending:
+                digest = cls.build_message(destination, text, photo_url_list or None, video_url_list or None)
+                digest.priority = pending[0].priority
+                result.append((digest, len(pending)))
+            pending.clear()
+
+        for message in message_list:
+            message_photo_url_list = message.photo_url_list or []
+            message_video_url_list = message.video_url_list or []
+            if message_video_url_list and not cls.digest_merge_video:
+                _flush()
+                result.append((message, 1))
+                continue
+            if pending:
+                merged_text = '{}\n\n{}'.format(text, message.text)
+                merged_media_count = len(photo_url_list) + len(video_url_list) + len(message_photo_url_list) + len(
+                    message_video_url_list)
+                if cls._exceed_digest_limit(merged_text, merged_media_count):
+                    _flush()
+            if pending:
+                text = merged_text
+            else:
+                text, photo_url_list, video_url_list = message.text, [], []
+            photo_url_list.extend(message_photo_url_list)
+            video_url_list.extend(message_video_url_list)
+            pending.append(message)
+        _flush()
+        cls.coalesced_message_count += len(message_list) - len(result)
+        return result
+
+    @classmethod
     @check_initialized
     def send_message(cls, message: Message):
-        pass
+        for destination in cls.get_destination_list(message):
+            cls.send_message_to_destination(destination, message)
 
     @classmethod
     @check_initialized
     def _work(cls):
         while True:
-            message = cls.message_queue.get()
+            destination = cls.ready_destinations.get()
+            destination_name = cls.get_destination_name(destination)
+            with cls.destination_lock:
+                # Only the messages of the highest queued priority are taken, the rest wait for the next turn.
+                destination_queue = next(
+                    priority_queue for priority_queue in cls.destination_queues[destination] if priority_queue)
+                if cls.coalesce_window:
+                    queued_list = list(destination_queue)
+                    destination_queue.clear()
+                else:
+                    queued_list = [destination_queue.popleft()]
+            for message, count in cls.merge_messages(destination, [queued[0] for queued in queued_list]):
+                merged_queued_list, queued_list = queued_list[:count], queued_list[count:]
+                entry_id_list = [entry_id for _, entry_id, _ in merged_queued_list if entry_id is not None]
+                error = cls._send_with_retry(destination, message)
+                if not error:
+                    sent_time = time.monotonic()
+                    now = time.time()
+                    for queued_message, _, enqueue_time in merged_queued_list:
+                        StatusTracker.update_queue_latency(cls.notifier_name, destination_name,
+                                                           sent_time - enqueue_time)
+                        if queued_message.poll_time:
+                            Metrics.observe('notify_lag_seconds',
+                                            now - queued_message.poll_time,
+                                            notifier=cls.notifier_name)
+                if cls.outbox and error:
+                    cls.outbox.dead_letter(entry_id_list, error)
+                elif cls.outbox:
+                    cls.outbox.ack(entry_id_list)
+            with cls.destination_lock:
+                depth = sum(len(priority_queue) for priority_queue in cls.destination_queues[destination])
+                if depth:
+                    cls._schedule_destination(destination)
+                else:
+                    cls.scheduled_destinations.discard(destination)
+            StatusTracker.set_queue_depth(cls.notifier_name, destination_name, depth)
+            Metrics.set('notifier_queue_depth', depth, notifier=cls.notifier_name, destination=destination_name)
+
+    @classmethod
+    def _send_with_retry(cls, destination, message: Message) -> Union[str, None]:
+        # Returns the last error if the message is not sent.
+        destination_name = cls.get_destination_name(destination)
+        for tries in range(cls.max_send_tries):
             try:
-                StatusTracker.set_notifier_status(cls.notifier_name, False)
-                cls.send_message(message)
-                StatusTracker.set_notifier_status(cls.notifier_name, True)
+                StatusTracker.set_notifier_status(cls.notifier_name, False, destination_name)
+                start_time = time.perf_counter()
+                cls.send_message_to_destination(destination, message)
+                duration = time.perf_counter() - start_time
+                StatusTracker.update_delivery_latency(cls.notifier_name, destination_name, duration)
+                Metrics.observe('notifier_send_duration_seconds',
+                                duration,
+                                notifier=cls.notifier_name,
+                                destination=destination_name)
+                StatusTracker.set_notifier_status(cls.notifier_name, True, destination_name)
+                return None
             except Exception as e:
                 print(e)
                 cls.logger.error(e)
+                error = str(e)
+                if tries + 1 < cls.max_send_tries:
+                    time.sleep(cls.send_retry_delay * 2**tries)
+        cls.logger.error('Failed to send message to {} after {} tries: {}'.format(destination_name, cls.max_send_tries,
+                                                                                  message.text))
+        return error
+
+    @classmethod
+    def _put_into_destination_queue(cls, destination, message: Message, entry_id: Union[int, None]):
+        queued = (message, entry_id, time.monotonic())
+        dropped = None
+        with cls.destination_lock:
+            priority_queue_list = cls.destination_queues.setdefault(destination, [deque() for _ in Priority])
+            depth = sum(len(priority_queue) for priority_queue in priority_queue_list)
+            if depth >= cls.queue_capacity:
+                lowest_priority = max(priority for priority in Priority if priority_queue_list[priority])
+                if lowest_priority >= message.priority:
+                    dropped = priority_queue_list[lowest_priority].popleft()
+                else:
+                    dropped = queued
+            if dropped is not queued:
+                priority_queue_list[message.priority].append(queued)
+            if not dropped:
+                depth += 1
+            if destination not in cls.scheduled_destinations:
+                cls.scheduled_destinations.add(destination)
+                cls._schedule_destination(destination)
+        destination_name = cls.get_destination_name(destination)
+        StatusTracker.set_queue_depth(cls.notifier_name, destination_name, depth)
+        Metrics.set('notifier_queue_depth', depth, notifier=cls.notifier_name, destination=destination_name)
+        if dropped:
+            dropped_message, dropped_entry_id, _ = dropped
+            cls.logger.error('Queue of {} is full, drop message: {}'.format(destination_name, dropped_message.text))
+            StatusTracker.update_dropped_message_count(cls.notifier_name, destination_name)
+            Metrics.inc('notifier_dropped_messages_total', notifier=cls.notifier_name, destination=destination_name)
+            if cls.outbox and dropped_entry_id is not None:
+                cls.outbox.dead_letter([dropped_entry_id], 'Queue overflow')
+
+    @classmethod
+    def _schedule_destination(cls, destination):
+        if not cls.coalesce_window:
+            cls.ready_destinations.put(destination)
+            return
+        with cls.delayed_destination_condition:
+            heapq.heappush(cls.delayed_destinations,
+                           (time.monotonic() + cls.coalesce_window, next(cls.delayed_destination_seq), destination))
+            cls.delayed_destination_condition.notify()
+
+    @classmethod
+    def _release_delayed_destinations(cls):
+        with cls.delayed_destination_condition:
+            while True:
+                if not cls.delayed_destinations:
+                    cls.delayed_destination_condition.wait()
+                    continue
+                wait_time = cls.delayed_destinations[0][0] - time.monotonic()
+                if wait_time > 0:
+                    cls.delayed_destination_condition.wait(wait_time)
+                    continue
+                cls.ready_destinations.put(heapq.heappop(cls.delayed_destinations)[2])
 
     @classmethod
     @check_initialized
     def work_start(cls):
-        threading.Thread(target=cls._work, daemon=True).start()
+        for _ in range(cls.concurrency):
+            threading.Thread(target=cls._work, daemon=True).start()
+        if cls.coalesce_window:
+            threading.Thread(target=cls._release_delayed_destinations, daemon=True).start()
 
     @classmethod
     @check_initialized
     def put_message_into_queue(cls, message: Message):
-        cls.message_queue.put(message)
+        for destination in cls.get_destination_list(message):
+            entry_id = cls.outbox.put(destination, message.text, message.photo_url_list, message.video_url_list,
+                                      message.priority) if cls.outbox else None
+            cls._put_into_destination_queue(destination, message, entry_id)
@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import List, Union
+
+
+class Outbox():
+    # Append-only journal of the messages queued to a notifier. Each queued message appends a put record and each
+    # delivered or dead-lettered message appends an ack record, so the messages without ack are replayed after a
+    # restart. Records are written by a background thread which fsyncs a whole batch at once, so putting a message
+    # never waits for the disk.
+    compact_threshold = 1000
+
+    def __init__(self, path: str, logger_name: str = 'outbox'):
+        self.path = path
+        self.dead_letter_path = path + '.dead'
+        self.logger = logging.getLogger(logger_name)
+        self.condition = threading.Condition()
+        self.dead_letter_lock = threading.Lock()
+        self.record_list = []
+        self.append_count = 0
+        self.written_count = 0
+        self.ack_count_since_compaction = 0
+        self.dead_letter_count = 0
+        # Records of the unacked messages, keyed by id in insertion order.
+        self.unacked_records = dict()
+        self.next_id = 0
+        self.file = None
+        self._load()
+        self._compact(list(self.unacked_records.values()))
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last record may be partially written by a crash.
+                    continue
+                if record['op'] == 'put':
+                    self.unacked_records[record['id']] = line if line.endswith('\n') else line + '\n'
+                    self.next_id = max(self.next_id, record['id'] + 1)
+                elif record['op'] == 'ack':
+                    for entry_id in record['id_list']:
+                        self.unacked_records.pop(entry_id, None)
+        if self.unacked_records:
+            self.logger.warning('Replay {} unacked messages from {}'.format(len(self.unacked_records), self.path))
+
+    def _compact(self, line_list: List[str]):
+        # Rewrite the journal with the given unacked records only. Only called by the writer, without the lock, so
+        # putting a message does not wait for the rewrite. The line list must be taken with no record waiting to be
+        # written, the records appended meanwhile are written to the new journal afterwards.
+        with open(self.path + '.tmp', 'w') as f:
+            f.writelines(line_list)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
+        if self.file:
+            self.file.close()
+        self.file = open(self.path, 'a')
+
+    def _append(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        self.record_list.append(line)
+        self.append_count += 1
+        self.condition.notify_all()
+        return line
+
+    def _write_loop(self):
+        while True:
+            with self.condition:
+                while not self.record_list:
+                    self.condition.wait()
+                record_list, self.record_list = self.record_list, []
+            self.file.write(''.join(record_list))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            with self.condition:
+                self.written_count += len(record_list)
+                line_list = None
+                if not self.record_list and self.ack_count_since_compaction >= self.compact_threshold:
+                    line_list = list(self.unacked_records.values())
+                    self.ack_count_since_compaction = 0
+                self.condition.notify_all()
+            if line_list is not None:
+                self._compact(line_list)
+
+    def get_unacked(self) -> List[tuple]:
+        # Returns (id, destination, text, photo_url_list, video_url_list, priority) of the unacked messages in order.
+        with self.condition:
+            record_list = [json.loads(line) for line in self.unacked_records.values()]
+        return [(record['id'], record['destination'], record['text'], record['photo_url_list'],
+                 record['video_url_list'], record.get('priority', 1)) for record in record_list]
+
+    def put(self,
+            destination,
+            text: str,
+            photo_url_list: Union[List[str], None],
+            video_url_list: Union[List[str], None],
+            priority: int = 1) -> int:
+        with self.condition:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.unacked_records[entry_id] = self._append({
+                'op': 'put',
+                'id': entry_id,
+                'time': time.time(),
+                'destination': destination,
+                'text': text,
+                'photo_url_list': photo_url_list,
+                'video_url_list': video_url_list,
+                'priority': int(priority)
+            })
+        return entry_id
+
+    def ack(self, id_list: List[int]):
+        with self.condition:
+            id_list = [entry_id for entry_id in id_list if self.unacked_records.pop(entry_id, None)]
+            if not id_list:
+                return
+            self._append({'op': 'ack', 'id_list': id_list})
+            self.ack_count_since_compaction += len(id_list)
+
+    def dead_letter(self, id_list: List[int], error: str):
+        with self.condition:
+            line_list = [self.unacked_records[entry_id] for entry_id in id_list if entry_id in self.unacked_records]
+        with self.dead_letter_lock:
+            with open(self.dead_letter_path, 'a') as f:
+                for line in line_list:
+                    record = json.loads(line)
+                    record['error'] = error
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.dead_letter_count += len(line_list)
+        self.ack(id_list)
+
+    def flush(self):
+        # Wait until all the appended records are written to the disk.
+        with self.condition:
+            target_count = self.append_count
+            while self.written_count < target_count:
+                self.condition.wait()
+
+    def status(self) -> dict:
+        with self.condition:
+            return {'unacked': len(self.unacked_records), 'dead_letter': self.dead_letter_count}
@@ -1,21 +1,30 @@
+import asyncio
+import concurrent.futures
+import logging
 import time
 from functools import cached_property
-from typing import Union
+from typing import Dict, List, Union
 
 from following_monitor import FollowingMonitor
+from graphql_api import GraphqlAPI
 from like_monitor import LikeMonitor
+from metrics import Metrics
 from monitor_base import MonitorBase, MonitorManager
 from tweet_monitor import TweetMonitor
-from utils import find_one, get_content
+from utils import find_one, get_content, USER_RESULT, USERS
 
 MESSAGE_TEMPLATE = '{} changed\nOld: {}\nNew: {}'
 SUB_MONITOR_LIST = [FollowingMonitor, LikeMonitor, TweetMonitor]
+PROFILE_ELEMENT_LIST = [
+    'name', 'username', 'location', 'bio', 'website', 'followers_count', 'following_count', 'like_count', 'tweet_count',
+    'profile_image_url', 'profile_banner_url', 'pinned_tweet', 'highlighted_tweet_count'
+]
 
 
 class ProfileParser():
 
     def __init__(self, json_response: dict):
-        self.content = get_content(find_one(json_response, 'user'))
+        self.content = get_content(USER_RESULT.extract_one(json_response))
         self.json_response = json_response
 
     @cached_property
@@ -114,34 +123,46 @@ class ProfileMonitor(MonitorBase):
                          user_config=user_config,
                          cookies_dir=cookies_dir)
 
-        self.original_username = username
-        json_response = self.get_user()
-        while not json_response:
-            time.sleep(60)
+        checkpoint = self.load_checkpoint()
+        if checkpoint:
+            elements = checkpoint
+        else:
             json_response = self.get_user()
-        parser = ProfileParser(json_response)
-        self.name = ElementBuffer(parser.name)
-        self.username = ElementBuffer(parser.username)
-        self.location = ElementBuffer(parser.location)
-        self.bio = ElementBuffer(parser.bio)
-        self.website = ElementBuffer(parser.website)
-        self.followers_count = ElementBuffer(parser.followers_count)
-        self.following_count = ElementBuffer(parser.following_count)
-        self.like_count = ElementBuffer(parser.like_count)
-        self.tweet_count = ElementBuffer(parser.tweet_count, change_threshold=1)
-        self.profile_image_url = ElementBuffer(parser.profile_image_url)
-        self.profile_banner_url = ElementBuffer(parser.profile_banner_url)
-        self.pinned_tweet = ElementBuffer(parser.pinned_tweet)
-        self.highlighted_tweet_count = ElementBuffer(parser.highlighted_tweet_count)
+            while not json_response:
+                time.sleep(60)
+                json_response = self.get_user()
+            parser = ProfileParser(json_response)
+            elements = {element_name: getattr(parser, element_name) for element_name in PROFILE_ELEMENT_LIST}
+        self.name = ElementBuffer(elements['name'])
+        self.username = ElementBuffer(elements['username'])
+        self.location = ElementBuffer(elements['location'])
+        self.bio = ElementBuffer(elements['bio'])
+        self.website = ElementBuffer(elements['website'])
+        self.followers_count = ElementBuffer(elements['followers_count'])
+        self.following_count = ElementBuffer(elements['following_count'])
+        self.like_count = ElementBuffer(elements['like_count'])
+        self.tweet_count = ElementBuffer(elements['tweet_count'], change_threshold=1)
+        self.profile_image_url = ElementBuffer(elements['profile_image_url'])
+        self.profile_banner_url = ElementBuffer(elements['profile_banner_url'])
+        self.pinned_tweet = ElementBuffer(elements['pinned_tweet'])
+        self.highlighted_tweet_count = ElementBuffer(elements['highlighted_tweet_count'])
 
         self.monitoring_following_count = user_config.get('monitoring_following_count', False)
         self.monitoring_tweet_count = user_config.get('monitoring_tweet_count', False)
         self.monitoring_like_count = user_config.get('monitoring_like_count', False)
 
-        self.title = title
         self.sub_monitor_up_to_date = {}
         for sub_monitor in SUB_MONITOR_LIST:
             self.sub_monitor_up_to_date[sub_monitor.monitor_type] = True
+        # The saved counts already include the changes of the sub monitors whose trigger failed, retry them.
+        for sub_monitor_type in elements.get('pending_sub_monitor_list', []):
+            self.sub_monitor_up_to_date[sub_monitor_type] = False
+
+        # Read by the adaptive polling scheduler.
+        self.watch_count = 0
+        self.last_changed = False
+        if not checkpoint:
+            self.save_checkpoint()
 
         self.logger.info('Init profile monitor succeed.\n{}'.format(self.__dict__))
 
@@ -149,38 +170,53 @@ class ProfileMonitor(MonitorBase):
         # params = {'userId': self.user_id}
         # json_response = self.twitter_watcher.query('UserByRestId', params)
         params = {'screen_name': self.original_username}
-        json_response = self.twitter_watcher.query('UserByScreenName', params)
-        if not find_one(json_response, 'user'):
+        json_response = self.twitter_watcher.query('UserByScreenName', params, use_cache=False)
+        if not USER_RESULT.extract_one(json_response):
             return None
         return json_response
 
-    def detect_change_and_update(self, user: dict):
+    async def get_user_async(self) -> Union[dict, None]:
+        params = {'screen_name': self.original_username}
+        json_response = await self.twitter_watcher.query_async('UserByScreenName', params, use_cache=False)
+        if not USER_RESULT.extract_one(json_response):
+            return None
+        return json_response
+
+    def detect_change_and_update(self, user: dict) -> bool:
+        # Returns whether the profile changed, the followers count excluded as it is not the user's activity.
         parser = ProfileParser(user)
+        changed = False
 
         result = self.name.push(parser.name)
         if result:
+            changed = True
             self.send_message(message=MESSAGE_TEMPLATE.format('Name', result['old'], result['new']))
 
         result = self.username.push(parser.username)
         if result:
+            changed = True
             self.send_message(message=MESSAGE_TEMPLATE.format('Username', result['old'], result['new']))
 
         result = self.location.push(parser.location)
         if result:
+            changed = True
             self.send_message(message=MESSAGE_TEMPLATE.format('Location', result['old'], result['new']))
 
         result = self.bio.push(parser.bio)
         if result:
+            changed = True
             self.send_message(message=MESSAGE_TEMPLATE.format('Bio', result['old'], result['new']))
 
         result = self.website.push(parser.website)
         if result:
+            changed = True
             self.send_message(message=MESSAGE_TEMPLATE.format('Website', result['old'], result['new']))
 
         result = self.followers_count.push(parser.followers_count)
 
         result = self.following_count.push(parser.following_count)
         if result:
+            changed = True
             if self.monitoring_following_count:
                 self.send_message(message=MESSAGE_TEMPLATE.format('Following count', result['old'], result['new']))
             else:
@@ -189,6 +225,7 @@ class ProfileMonitor(MonitorBase):
 
         result = self.like_count.push(parser.like_count)
         if result:
+            changed = True
             if self.monitoring_like_count:
                 self.send_message(message=MESSAGE_TEMPLATE.format('Like count', result['old'], result['new']))
             else:
@@ -198,6 +235,7 @@ class ProfileMonitor(MonitorBase):
 
         result = self.tweet_count.push(parser.tweet_count)
         if result:
+            changed = True
             if self.monitoring_tweet_count:
                 self.send_message(message=MESSAGE_TEMPLATE.format('Tweet count', result['old'], result['new']))
             else:
@@ -207,22 +245,28 @@ class ProfileMonitor(MonitorBase):
 
         result = self.profile_image_url.push(parser.profile_image_url)
         if result:
+            changed = True
             self.send_message(message=MESSAGE_TEMPLATE.format('Profile image', result['old'], result['new']),
                               photo_url_list=[result['old'], result['new']])
 
         result = self.profile_banner_url.push(parser.profile_banner_url)
         if result:
+            changed = True
             self.send_message(message=MESSAGE_TEMPLATE.format('Profile banner', result['old'], result['new']),
                               photo_url_list=[result['old'], result['new']])
 
         result = self.pinned_tweet.push(parser.pinned_tweet)
         if result:
+            changed = True
             self.send_message(message=MESSAGE_TEMPLATE.format('Pinned tweet', result['old'], result['new']))
 
         result = self.highlighted_tweet_count.push(parser.highlighted_tweet_count)
         if result:
+            changed = True
             self.send_message(message=MESSAGE_TEMPLATE.format('Highlighted tweet', result['old'], result['new']))
 
+        return changed
+
     def watch_sub_monitor(self):
         for sub_monitor in SUB_MONITOR_LIST:
             sub_monitor_type = sub_monitor.monitor_type
@@ -235,13 +279,142 @@ class ProfileMonitor(MonitorBase):
                     sub_monitor_instance.update_last_watch_time()
 
     def watch(self) -> bool:
+        self.poll_time = time.time()
         user = self.get_user()
         if not user:
             return False
-        self.detect_change_and_update(user)
-        self.watch_sub_monitor()
-        self.update_last_watch_time()
+        return self.process_user(user)
+
+    def process_user(self, user: dict) -> bool:
+        with Metrics.timer('monitor_watch_duration_seconds', monitor_type=self.monitor_type):
+            self.last_changed = self.detect_change_and_update(user)
+            self.watch_sub_monitor()
+            self.update_last_watch_time()
+            self.save_checkpoint()
+            self.watch_count += 1
+        return True
+
+    async def watch_async(self) -> bool:
+        self.poll_time = time.time()
+        user = await self.get_user_async()
+        if not user:
+            return False
+        return await self.process_user_async(user)
+
+    async def process_user_async(self, user: dict) -> bool:
+        with Metrics.timer('monitor_watch_duration_seconds', monitor_type=self.monitor_type):
+            self.last_changed = self.detect_change_and_update(user)
+            if all(self.sub_monitor_up_to_date.values()):
+                self.watch_sub_monitor()
+            else:
+                # Sub monitors are triggered rarely and still use the blocking client, keep them off the event loop.
+                await asyncio.to_thread(self.watch_sub_monitor)
+            self.update_last_watch_time()
+            self.save_checkpoint()
+            self.watch_count += 1
         return True
 
     def status(self) -> str:
         return 'Last: {}, username: {}'.format(self.get_last_watch_time(), self.username.element)
+
+    def get_checkpoint(self) -> dict:
+        checkpoint = {element_name: getattr(self, element_name).element for element_name in PROFILE_ELEMENT_LIST}
+        checkpoint['pending_sub_monitor_list'] = sorted(
+            sub_monitor_type for sub_monitor_type, up_to_date in self.sub_monitor_up_to_date.items() if not up_to_date)
+        return checkpoint
+
+
+class ProfileBatchWatcher():
+    # Fetch the profiles of many users per request with the bulk users-by-ids API,
+    # fall back to single requests if the bulk API is unavailable or batch_size is 0.
+    api_name = 'UsersByRestIds'
+
+    def __init__(self, monitor_list: List[ProfileMonitor], batch_size: int):
+        assert monitor_list
+        self.monitor_list = monitor_list
+        self.batch_size = batch_size
+        self.twitter_watcher = monitor_list[0].twitter_watcher
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(monitor_list))
+        # A monitor still processing the previous result (e.g. running sub monitors) is not due.
+        self.pending = dict()
+        self.logger = logging.getLogger('profile-batch')
+
+    def _get_due_monitor_list(self, monitor_list: Union[List[ProfileMonitor], None]) -> List[ProfileMonitor]:
+        if monitor_list is None:
+            monitor_list = self.monitor_list
+        return [monitor for monitor in monitor_list if monitor not in self.pending]
+
+    def _get_batch_list(self, monitor_list: List[ProfileMonitor]) -> List[List[ProfileMonitor]]:
+        if self.batch_size <= 0:
+            return [monitor_list] if monitor_list else []
+        return [monitor_list[i:i + self.batch_size] for i in range(0, len(monitor_list), self.batch_size)]
+
+    def is_pending(self, monitor: ProfileMonitor) -> bool:
+        return monitor in self.pending
+
+    def _get_params(self, batch: List[ProfileMonitor]) -> dict:
+        return {'userIds': [monitor.user_id for monitor in batch]}
+
+    def _parse_users(self, json_response: Union[dict, None]) -> Dict[str, dict]:
+        # Wrap each user in the UserByScreenName response structure, so that ProfileParser can read it.
+        users = dict()
+        for user in USERS.extract_one(json_response) or []:
+            user_id = find_one(user, 'rest_id')
+            if user_id:
+                users[user_id] = {'data': {'user': user}}
+        return users
+
+    def _check_missing_users(self, batch: List[ProfileMonitor], users: Dict[str, dict]):
+        if len(users) < len(batch):
+            self.logger.warning('Bulk query returned {}/{} users, others fall back to single requests.'.format(
+                len(users), len(batch)))
+
+    def _submit(self, monitor: ProfileMonitor, user: Union[dict, None]):
+        future = self.executor.submit(monitor.process_user, user) if user else self.executor.submit(monitor.watch)
+        self.pending[monitor] = future
+        future.add_done_callback(lambda future: self._on_done(monitor, future))
+
+    def _on_done(self, monitor: ProfileMonitor, future: concurrent.futures.Future):
+        self.pending.pop(monitor, None)
+        if future.exception():
+            self.logger.error('{} watch error: {}'.format(monitor.title, future.exception()))
+
+    def watch(self, monitor_list: Union[List[ProfileMonitor], None] = None):
+        # Watch the given monitors, or all of them, skipping the ones still pending.
+        due_monitor_list = self._get_due_monitor_list(monitor_list)
+        bulk = self.batch_size > 0 and GraphqlAPI.has_api(self.api_name)
+        for batch in self._get_batch_list(due_monitor_list):
+            users = dict()
+            poll_time = time.time()
+            for monitor in batch:
+                monitor.poll_time = poll_time
+            if bulk:
+                users = self._parse_users(self.twitter_watcher.query(self.api_name, self._get_params(batch)))
+                self._check_missing_users(batch, users)
+            for monitor in batch:
+                self._submit(monitor, users.get(monitor.user_id, None))
+
+    async def _process_async(self, monitor: ProfileMonitor, user: Union[dict, None]):
+        try:
+            if user:
+                await monitor.process_user_async(user)
+            else:
+                await monitor.watch_async()
+        finally:
+            self.pending.pop(monitor, None)
+
+    async def watch_async(self, monitor_list: Union[List[ProfileMonitor], None] = None):
+        due_monitor_list = self._get_due_monitor_list(monitor_list)
+        bulk = self.batch_size > 0 and GraphqlAPI.has_api(self.api_name)
+        for batch in self._get_batch_list(due_monitor_list):
+            users = dict()
+            poll_time = time.time()
+            for monitor in batch:
+                monitor.poll_time = poll_time
+            if bulk:
+                users = self._parse_users(await self.twitter_watcher.query_async(self.api_name,
+                                                                                 self._get_params(batch)))
+                self._check_missing_users(batch, users)
+            for monitor in batch:
+                self.pending[monitor] = asyncio.ensure_future(
+                    self._process_async(monitor, users.get(monitor.user_id, None)))
@@ -1,5 +1,6 @@
 import logging
 from datetime import datetime, timedelta, timezone
+from typing import Union
 
 
 class StatusTracker():
@@ -9,6 +10,13 @@ class StatusTracker():
 
     monitors_status = dict()
     notifiers_status = dict()
+    delivery_latency = dict()
+    queue_latency = dict()
+    queue_depth = dict()
+    checked_queue_depth = dict()
+    dropped_message_count = dict()
+    # Alert when a notifier queue has at least this many messages and is not shrinking.
+    backlog_alert_threshold = 100
 
     logger = logging.getLogger('status')
 
@@ -23,8 +31,55 @@ class StatusTracker():
         return cls.monitors_status.get(key, None)
 
     @classmethod
-    def set_notifier_status(cls, notifier: str, status: bool):
-        cls.notifiers_status[notifier] = status
+    def set_notifier_status(cls, notifier: str, status: bool, destination=None):
+        # Each destination is sent by one worker at a time, so its status is not overwritten by the other workers.
+        key = notifier if destination is None else '{}-{}'.format(notifier, destination)
+        cls.notifiers_status[key] = status
+
+    @staticmethod
+    def _update_latency(latency_dict: dict, key: str, latency: float):
+        count, total, maximum, _ = latency_dict.get(key, (0, 0.0, 0.0, 0.0))
+        latency_dict[key] = (count + 1, total + latency, max(maximum, latency), latency)
+
+    @staticmethod
+    def _summarize_latency(latency_dict: dict, key: str) -> Union[dict, None]:
+        if key not in latency_dict:
+            return None
+        count, total, maximum, last = latency_dict[key]
+        return {'count': count, 'avg': round(total / count, 3), 'max': round(maximum, 3), 'last': round(last, 3)}
+
+    @classmethod
+    def update_delivery_latency(cls, notifier: str, destination, latency: float):
+        cls._update_latency(cls.delivery_latency, '{}-{}'.format(notifier, destination), latency)
+
+    @classmethod
+    def get_delivery_latency(cls) -> dict:
+        return {key: cls._summarize_latency(cls.delivery_latency, key) for key in list(cls.delivery_latency.keys())}
+
+    @classmethod
+    def update_queue_latency(cls, notifier: str, destination, latency: float):
+        # From a message put into the queue to it being sent.
+        cls._update_latency(cls.queue_latency, '{}-{}'.format(notifier, destination), latency)
+
+    @classmethod
+    def set_queue_depth(cls, notifier: str, destination, depth: int):
+        cls.queue_depth['{}-{}'.format(notifier, destination)] = depth
+
+    @classmethod
+    def update_dropped_message_count(cls, notifier: str, destination):
+        key = '{}-{}'.format(notifier, destination)
+        cls.dropped_message_count[key] = cls.dropped_message_count.get(key, 0) + 1
+
+    @classmethod
+    def get_queue_status(cls) -> dict:
+        result = dict()
+        for key, depth in list(cls.queue_depth.items()):
+            result[key] = {
+                'depth': depth,
+                'dropped': cls.dropped_message_count.get(key, 0),
+                'latency': cls._summarize_latency(cls.queue_latency, key)
+            }
+        return result
 
     @classmethod
     def check(cls) -> list:
@@ -36,9 +91,15 @@ class StatusTracker():
             if monitor_status < monitor_time_threshold:
                 alerts.append('{}: {}'.format(monitor_name, monitor_status))
 
-        for notifier_name, notifier_status in cls.notifiers_status.items():
+        for notifier_name, notifier_status in list(cls.notifiers_status.items()):
             cls.logger.info('{}: {}'.format(notifier_name, notifier_status))
             if notifier_status is False:
                 alerts.append('{}'.format(notifier_name))
 
+        for queue_name, depth in list(cls.queue_depth.items()):
+            cls.logger.info('{} queue depth: {}'.format(queue_name, depth))
+            if depth >= cls.backlog_alert_threshold and depth >= cls.checked_queue_depth.get(queue_name, 0):
+                alerts.append('{} backlog: {}'.format(queue_name, depth))
+            cls.checked_queue_depth[queue_name] = depth
+
         return alerts
@@ -1,7 +1,10 @@
+import atexit
+import json
 import logging
 import os
 import threading
 import time
+from collections import OrderedDict
 from datetime import datetime, timezone
 from typing import List, Union
 
@@ -9,7 +12,7 @@ import telegram
 from retry import retry
 from telegram.error import BadRequest, RetryAfter, TimedOut, NetworkError
 
-from notifier_base import Message, NotifierBase
+from notifier_base import Message, NotifierBase, Priority
 
 
 class TelegramMessage(Message):
@@ -18,52 +21,220 @@ class TelegramMessage(Message):
                  chat_id_list: List[int],
                  text: str,
                  photo_url_list: Union[List[str], None] = None,
-                 video_url_list: Union[List[str], None] = None):
-        super().__init__(text, photo_url_list, video_url_list)
+                 video_url_list: Union[List[str], None] = None,
+                 priority: Priority = Priority.NORMAL):
+        super().__init__(text, photo_url_list, video_url_list, priority)
         self.chat_id_list = chat_id_list
 
 
+class FileIdCache():
+    # LRU map from media url to the telegram file id of the uploaded media, so that telegram does not download
+    # the same media again for every chat. Persisted as json when a path is given.
+    flush_interval = 60
+
+    def __init__(self, max_size: int, path: str = ''):
+        self.max_size = max_size
+        self.path = path
+        self.lock = threading.Lock()
+        self.file_id_dict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                try:
+                    self.file_id_dict.update(json.load(f))
+                except ValueError:
+                    pass
+            while len(self.file_id_dict) > self.max_size:
+                self.file_id_dict.popitem(last=False)
+        # url: event set when the upload of the url finishes
+        self.uploads = dict()
+        # New ids are written to the file by a periodic flush instead of a rewrite per id.
+        self.dirty = False
+        if path:
+            threading.Thread(target=self._flush_periodically, daemon=True).start()
+            atexit.register(self.flush)
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.path or not self.dirty:
+                return
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.file_id_dict, f)
+            os.replace(self.path + '.tmp', self.path)
+            self.dirty = False
+
+    def get(self, url: str) -> Union[str, None]:
+        with self.lock:
+            file_id = self.file_id_dict.get(url, None)
+            if file_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.file_id_dict.move_to_end(url)
+            return file_id
+
+    def put(self, url: str, file_id: str):
+        with self.lock:
+            if self.file_id_dict.get(url, None) == file_id:
+                self.file_id_dict.move_to_end(url)
+                return
+            self.file_id_dict[url] = file_id
+            self.file_id_dict.move_to_end(url)
+            while len(self.file_id_dict) > self.max_size:
+                self.file_id_dict.popitem(last=False)
+            self.dirty = True
+
+    def remove(self, url_list: List[str]) -> bool:
+        # Returns whether any of the urls was cached.
+        with self.lock:
+            removed = [self.file_id_dict.pop(url, None) for url in url_list]
+            if not any(removed):
+                return False
+            self.dirty = True
+            return True
+
+    def start_upload(self, url_list: List[str]) -> Union[threading.Event, None]:
+        # Single-flight of the uploads: waits while other senders are uploading any of the uncached urls. Returns an
+        # event when the caller has to upload the uncached urls itself, it must then call finish_upload with it. If
+        # the other upload failed, the urls are still uncached and the caller uploads them.
+        while True:
+            with self.lock:
+                uncached_url_list = [url for url in url_list if url not in self.file_id_dict]
+                if not uncached_url_list:
+                    return None
+                upload_list = [self.uploads[url] for url in uncached_url_list if url in self.uploads]
+                if not upload_list:
+                    upload = threading.Event()
+                    for url in uncached_url_list:
+                        self.uploads[url] = upload
+                    return upload
+            upload_list[0].wait()
+
+    def finish_upload(self, url_list: List[str], upload: threading.Event):
+        with self.lock:
+            for url in url_list:
+                if self.uploads.get(url, None) is upload:
+                    del self.uploads[url]
+        upload.set()
+
+    def status(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.file_id_dict),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0
+            }
+
+
 class TelegramNotifier(NotifierBase):
     notifier_name = 'Telegram'
+    # https://core.telegram.org/bots/api#sendmessage, sendphoto and sendmediagroup
+    digest_text_limit = 4096
+    digest_caption_limit = 1024
+    digest_media_limit = 10
+    # Only the first video of a message is sent, so keep the messages with videos unmerged.
+    digest_merge_video = False
+    file_id_cache_size = 2000
 
     @classmethod
-    def init(cls, token: str, logger_name: str):
+    def init(cls,
+             token: str,
+             logger_name: str,
+             concurrency: int = 1,
+             coalesce_window: float = 0,
+             file_id_cache_path: str = '',
+             outbox_dir: str = '',
+             queue_capacity: int = 1000):
         assert token
-        cls.bot = telegram.Bot(token=token, request=telegram.utils.request.Request(con_pool_size=2))
+        cls.file_id_cache = FileIdCache(cls.file_id_cache_size, file_id_cache_path)
+        # One more connection for getting updates
+        cls.bot = telegram.Bot(token=token,
+                               request=telegram.utils.request.Request(con_pool_size=max(concurrency, 1) + 1))
         cls.logger = logging.getLogger('{}'.format(logger_name))
         updates = cls._get_updates()
         cls.update_offset = updates[-1].update_id + 1 if updates else None
         cls.logger.info('Init telegram notifier succeed.')
-        super().init()
+        super().init(concurrency, coalesce_window, outbox_dir, queue_capacity)
 
     @classmethod
     @retry((RetryAfter, TimedOut, NetworkError), delay=10, tries=10)
     def _send_message_to_single_chat(cls, chat_id: str, text: str, photo_url_list: Union[List[str], None],
                                      video_url_list: Union[List[str], None]):
+        # Media already uploaded to telegram is sent by its file id. Media being uploaded for another chat is waited
+        # for, so that it is uploaded only once.
+        media_url_list = video_url_list[:1] if video_url_list else (photo_url_list or [])[:10]
+        upload = cls.file_id_cache.start_upload(media_url_list)
+        try:
+            cls._send_media_message(chat_id, text, photo_url_list, video_url_list)
+        finally:
+            if upload:
+                cls.file_id_cache.finish_upload(media_url_list, upload)
+
+    @classmethod
+    def _send_media_message(cls, chat_id: str, text: str, photo_url_list: Union[List[str], None],
+                            video_url_list: Union[List[str], None]):
         if video_url_list:
-            cls.bot.send_video(chat_id=chat_id, video=video_url_list[0], caption=text, timeout=60)
+            video_url = video_url_list[0]
+            sent_message = cls.bot.send_video(chat_id=chat_id,
+                                              video=cls.file_id_cache.get(video_url) or video_url,
+                                              caption=text,
+                                              timeout=60)
+            video = sent_message.video or sent_message.animation or sent_message.document
+            if video:
+                cls.file_id_cache.put(video_url, video.file_id)
         elif photo_url_list:
+            photo_url_list = photo_url_list[:10]
+            media_list = [cls.file_id_cache.get(photo_url) or photo_url for photo_url in photo_url_list]
             if len(photo_url_list) == 1:
-                cls.bot.send_photo(chat_id=chat_id, photo=photo_url_list[0], caption=text, timeout=60)
+                sent_message_list = [cls.bot.send_photo(chat_id=chat_id, photo=media_list[0], caption=text, timeout=60)]
             else:
-                media_group = [telegram.InputMediaPhoto(media=photo_url_list[0], caption=text)]
-                for photo_url in photo_url_list[1:10]:
-                    media_group.append(telegram.InputMediaPhoto(media=photo_url))
-                cls.bot.send_media_group(chat_id=chat_id, media=media_group, timeout=60)
+                media_group = [telegram.InputMediaPhoto(media=media_list[0], caption=text)]
+                for media in media_list[1:]:
+                    media_group.append(telegram.InputMediaPhoto(media=media))
+                sent_message_list = cls.bot.send_media_group(chat_id=chat_id, media=media_group, timeout=60)
+            for photo_url, sent_message in zip(photo_url_list, sent_message_list):
+                if sent_message.photo:
+                    cls.file_id_cache.put(photo_url, sent_message.photo[-1].file_id)
         else:
             cls.bot.send_message(chat_id=chat_id, text=text, disable_web_page_preview=True, timeout=60)
 
     @classmethod
-    def send_message(cls, message: TelegramMessage):
+    def get_destination_list(cls, message: TelegramMessage) -> List[int]:
+        assert isinstance(message, TelegramMessage)
+        return message.chat_id_list
+
+    @classmethod
+    def build_message(cls, chat_id: int, text: str, photo_url_list: Union[List[str], None],
+                      video_url_list: Union[List[str], None]) -> TelegramMessage:
+        return TelegramMessage([chat_id], text, photo_url_list, video_url_list)
+
+    @classmethod
+    def send_message_to_destination(cls, chat_id: int, message: TelegramMessage):
         assert cls.initialized
         assert isinstance(message, TelegramMessage)
-        for chat_id in message.chat_id_list:
-            try:
-                cls._send_message_to_single_chat(chat_id, message.text, message.photo_url_list, message.video_url_list)
-            except BadRequest as e:
-                # Telegram cannot send some photos/videos for unknown reasons.
-                cls.logger.error('{}, trying to send message without media.'.format(e))
-                cls._send_message_to_single_chat(chat_id, message.text, None, None)
+        try:
+            cls._send_message_to_single_chat(chat_id, message.text, message.photo_url_list, message.video_url_list)
+        except BadRequest as e:
+            if cls.file_id_cache.remove((message.photo_url_list or []) + (message.video_url_list or [])):
+                # The cached file id may be invalid, send the media by url again.
+                cls.logger.warning('{}, trying to send message without cached file id.'.format(e))
+                try:
+                    cls._send_message_to_single_chat(chat_id, message.text, message.photo_url_list,
+                                                     message.video_url_list)
+                    return
+                except BadRequest as retry_error:
+                    e = retry_error
+            # Telegram cannot send some photos/videos for unknown reasons.
+            cls.logger.error('{}, trying to send message without media.'.format(e))
+            cls._send_message_to_single_chat(chat_id, message.text, None, None)
 
     @classmethod
     @retry((RetryAfter, TimedOut, NetworkError), delay=60)
@@ -88,6 +259,7 @@ class TelegramNotifier(NotifierBase):
         assert cls.initialized
         assert isinstance(message, TelegramMessage)
         message.text = '{}\nPlease reply Y/N'.format(message.text)
+        message.priority = Priority.ALERT
         cls.put_message_into_queue(message)
         sending_time = datetime.now(timezone.utc)
         while True:
@@ -119,9 +291,12 @@ class TelegramNotifier(NotifierBase):
                     text = received_message.text.upper()
                     if text == 'EXIT':
                         if cls.confirm(TelegramMessage([chat_id], 'Do you want to exit the program?')):
-                            cls.put_message_into_queue(TelegramMessage([chat_id], 'Program will exit after 5 sec.'))
+                            cls.put_message_into_queue(
+                                TelegramMessage([chat_id], 'Program will exit after 5 sec.', priority=Priority.ALERT))
                             cls.logger.error('The program exits by the telegram command')
                             time.sleep(5)
+                            # os._exit skips the atexit handlers.
+                            cls.file_id_cache.flush()
                             os._exit(0)
                 time.sleep(20)
 
@@ -0,0 +1,68 @@
+from like_monitor import LikeIdCache, LikeMonitor
+
+
+def _like(rest_id: str) -> dict:
+    return {
+        'tweet_results': {
+            'result': {
+                '__typename': 'Tweet',
+                'rest_id': rest_id,
+                'core': {
+                    'user_results': {
+                        'result': {
+                            'rest_id': '1',
+                            'legacy': {
+                                'screen_name': 'user'
+                            }
+                        }
+                    }
+                },
+                'legacy': {
+                    'full_text': 'like {}'.format(rest_id)
+                }
+            }
+        }
+    }
+
+
+TOMBSTONE = {'tweet_results': {'result': {'__typename': 'TweetTombstone', 'tombstone': {'text': {'text': 'Gone'}}}}}
+
+
+class _Watcher():
+
+    def __init__(self, entries: list):
+        self.entries = entries
+
+    def query(self, api_name: str, params: dict) -> dict:
+        return {'entries': self.entries}
+
+
+def _build_monitor(entries: list) -> LikeMonitor:
+    monitor = LikeMonitor.__new__(LikeMonitor)
+    monitor.user_id = '1'
+    monitor.twitter_watcher = _Watcher(entries)
+    monitor.existing_like_id_cache = LikeIdCache(LikeMonitor.like_id_set_max_size)
+    monitor.sent_messages = []
+    monitor.send_message = lambda text, photos, videos, priority: monitor.sent_messages.append(text)
+    monitor.update_last_watch_time = lambda: None
+    monitor.save_checkpoint = lambda: None
+    return monitor
+
+
+def test_like_id_cache_ignores_missing_ids():
+    cache = LikeIdCache(4, ['10', None, '11'])
+    assert list(cache) == [10, 11]
+    assert None not in cache
+    assert 'unavailable' not in cache
+    assert '10' in cache
+
+
+def test_watch_skips_tombstone():
+    monitor = _build_monitor([TOMBSTONE, _like('20')])
+    assert [like.rest_id for like in monitor.get_like_list()] == ['20']
+    monitor.existing_like_id_cache.add('20')
+
+    monitor.twitter_watcher.entries = [_like('21'), TOMBSTONE, _like('20')]
+    assert monitor.watch()
+    assert monitor.sent_messages == ['@user: like 21']
+    assert '21' in monitor.existing_like_id_cache
@@ -0,0 +1,37 @@
+import base64
+import hashlib
+import math
+import random
+import time
+
+# XOR_TABLES[n] maps every byte b to b ^ n, for bytes.translate.
+XOR_TABLES = tuple(bytes(b ^ n for b in range(256)) for n in range(256))
+
+
+class TransactionIdGenerator():
+    # Generates the same ids as ClientTransaction.generate_transaction_id from its key material. The key is decoded
+    # once instead of once per id, and the hash only changes with (method, path, second), so it is cached. A fresh
+    # random byte is still drawn for every id.
+
+    def __init__(self, key: str, animation_key: str, random_keyword: str, random_number: int):
+        self.key_bytes = base64.b64decode(key)
+        self.hash_suffix = '{}{}'.format(random_keyword, animation_key)
+        self.random_number = bytes([random_number])
+        # (method, path): (time_now, bytes to be xored)
+        self.payload_cache = dict()
+
+    def _get_payload(self, method: str, path: str, time_now: int) -> bytes:
+        key = (method, path)
+        cached = self.payload_cache.get(key, None)
+        if cached is not None and cached[0] == time_now:
+            return cached[1]
+        hash_val = hashlib.sha256('{}!{}!{}{}'.format(method, path, time_now, self.hash_suffix).encode()).digest()
+        payload = self.key_bytes + time_now.to_bytes(4, 'little') + hash_val[:16] + self.random_number
+        self.payload_cache[key] = (time_now, payload)
+        return payload
+
+    def generate(self, method: str, path: str) -> str:
+        time_now = math.floor((time.time() * 1000 - 1682924400 * 1000) / 1000)
+        payload = self._get_payload(method, path, time_now)
+        random_num = random.getrandbits(8)
+        return base64.b64encode(bytes((random_num,)) + payload.translate(XOR_TABLES[random_num])).decode().rstrip('=')
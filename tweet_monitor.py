@@ -1,17 +1,16 @@
+import concurrent.futures
 import time
 from datetime import datetime, timedelta, timezone
+from typing import List, Union
 
 from monitor_base import MonitorBase
-from utils import parse_media_from_tweet, parse_text_from_tweet, parse_create_time_from_tweet, find_all, find_one, get_content, convert_html_to_text
-
-
-def _verify_tweet_user_id(tweet: dict, user_id: str) -> bool:
-    user = find_one(tweet, 'user_results')
-    return find_one(user, 'rest_id') == user_id
+from tweet_view import TweetView
+from utils import find_one, TIMELINE_TWEET_RESULTS
 
 
 class TweetMonitor(MonitorBase):
     monitor_type = 'Tweet'
+    max_detail_concurrency = 4
 
     def __init__(self, username: str, title: str, token_config: dict, user_config: dict, cookies_dir: str):
         super().__init__(monitor_type=self.monitor_type,
@@ -21,26 +20,34 @@ class TweetMonitor(MonitorBase):
                          user_config=user_config,
                          cookies_dir=cookies_dir)
 
-        tweet_list = self.get_tweet_list()
-        while tweet_list is None:
-            time.sleep(60)
+        # Tweets posted while the program was down are sent on the first watch after a warm restart.
+        self.catch_up_time = None
+        checkpoint = self.load_checkpoint()
+        if checkpoint:
+            self.last_tweet_id = checkpoint['last_tweet_id']
+            self.catch_up_time = datetime.fromtimestamp(checkpoint['watch_time'], timezone.utc)
+        else:
             tweet_list = self.get_tweet_list()
+            while tweet_list is None:
+                time.sleep(60)
+                tweet_list = self.get_tweet_list()
 
-        self.last_tweet_id = -1
-        for tweet in tweet_list:
-            if _verify_tweet_user_id(tweet, self.user_id):
-                self.last_tweet_id = max(self.last_tweet_id, int(find_one(tweet, 'rest_id')))
+            self.last_tweet_id = -1
+            for tweet in tweet_list:
+                if tweet.user_id == self.user_id:
+                    self.last_tweet_id = max(self.last_tweet_id, int(tweet.rest_id))
+            self.save_checkpoint()
 
         self.logger.info('Init tweet monitor succeed.\nUser id: {}\nLast tweet: {}'.format(
             self.user_id, self.last_tweet_id))
 
-    def get_tweet_list(self) -> dict:
+    def get_tweet_list(self) -> Union[List[TweetView], None]:
         api_name = 'UserTweetsAndReplies'
         params = {'userId': self.user_id, 'includePromotedContent': True, 'withVoice': True, 'count': 1000}
         json_response = self.twitter_watcher.query(api_name, params)
         if json_response is None:
             return None
-        return find_all(json_response, 'tweet_results')
+        return [TweetView(tweet) for tweet in TIMELINE_TWEET_RESULTS.extract_all(json_response)]
 
     def get_tweet_detail(self, tweet_id: str) -> dict:
         api_name = 'TweetDetail'
@@ -60,6 +67,24 @@ class TweetMonitor(MonitorBase):
                 return entry
         return json_response
 
+    def complete_tweet_list(self, tweet_list: List[TweetView]) -> List[TweetView]:
+        # Timeline entries usually have everything a message needs, only the incomplete ones are fetched with
+        # TweetDetail, concurrently. The order is kept.
+        incomplete_index_list = [index for index, tweet in enumerate(tweet_list) if not tweet.is_complete()]
+        if not incomplete_index_list:
+            return tweet_list
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(len(incomplete_index_list), self.max_detail_concurrency)) as executor:
+            detail_list = list(
+                executor.map(lambda index: TweetView(self.get_tweet_detail(tweet_list[index].rest_id)),
+                             incomplete_index_list))
+        tweet_list = list(tweet_list)
+        for index, detail in zip(incomplete_index_list, detail_list):
+            # Keep the timeline entry when the request fails.
+            if detail.rest_id == tweet_list[index].rest_id:
+                tweet_list[index] = detail
+        return tweet_list
+
     def watch(self) -> bool:
         tweet_list = self.get_tweet_list()
         if tweet_list is None:
@@ -68,13 +93,16 @@ class TweetMonitor(MonitorBase):
         max_tweet_id = -1
         new_tweet_list = []
         time_threshold = datetime.now(timezone.utc) - timedelta(minutes=5)
+        if self.catch_up_time:
+            time_threshold = max(min(time_threshold, self.catch_up_time),
+                                 datetime.now(timezone.utc) - timedelta(days=1))
         for tweet in tweet_list:
-            if not _verify_tweet_user_id(tweet, self.user_id):
+            if tweet.user_id != self.user_id:
                 continue
-            tweet_id = int(find_one(tweet, 'rest_id'))
+            tweet_id = int(tweet.rest_id)
             if tweet_id <= self.last_tweet_id:
                 continue
-            if parse_create_time_from_tweet(tweet) < time_threshold:
+            if tweet.create_time < time_threshold:
                 continue
 
             new_tweet_list.append(tweet)
@@ -82,29 +110,29 @@ class TweetMonitor(MonitorBase):
 
         self.last_tweet_id = max(self.last_tweet_id, max_tweet_id)
 
-        for tweet in reversed(new_tweet_list):
-            tweet_id = find_one(tweet, 'rest_id')
-            tweet_detail = self.get_tweet_detail(tweet_id)
-            text = parse_text_from_tweet(tweet_detail)
-            retweet = find_one(tweet_detail, 'retweeted_status_result')
-            quote = find_one(tweet_detail, 'quoted_status_result')
+        for tweet_detail in reversed(self.complete_tweet_list(new_tweet_list)):
+            tweet_id = tweet_detail.rest_id
+            text = tweet_detail.text
+            retweet = tweet_detail.retweet
+            quote = tweet_detail.quote
             if retweet:
-                photo_url_list, video_url_list = parse_media_from_tweet(retweet)
+                photo_url_list, video_url_list = retweet.photo_url_list, retweet.video_url_list
             else:
-                photo_url_list, video_url_list = parse_media_from_tweet(tweet_detail)
+                photo_url_list, video_url_list = tweet_detail.photo_url_list, tweet_detail.video_url_list
                 if quote:
-                    quote_text = get_content(quote).get('full_text', '')
-                    quote_user = find_one(quote, 'user_results')
-                    quote_username = find_one(quote_user, 'screen_name')
-                    text += '\n\nQuote: @{}: {}'.format(quote_username, quote_text)
-            source = find_one(tweet_detail, 'source')
-            text += '\n\nSource: {}'.format(convert_html_to_text(source))
+                    text += '\n\nQuote: @{}: {}'.format(quote.screen_name, quote.full_text)
+            text += '\n\nSource: {}'.format(tweet_detail.source_text)
             tweet_link = "https://x.com/{}/status/{}".format(self.user_id, tweet_id)
             text += f"\nLink: {tweet_link}"
             self.send_message(text, photo_url_list, video_url_list)
 
+        self.catch_up_time = None
         self.update_last_watch_time()
+        self.save_checkpoint()
         return True
 
     def status(self) -> str:
         return 'Last: {}, id: {}'.format(self.get_last_watch_time(), self.last_tweet_id)
+
+    def get_checkpoint(self) -> dict:
+        return {'last_tweet_id': self.last_tweet_id, 'watch_time': datetime.now(timezone.utc).timestamp()}
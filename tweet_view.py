@@ -0,0 +1,114 @@
+from datetime import datetime, timezone
+from typing import Union
+
+from utils import convert_html_to_text, convert_source_to_text, find_one, get_content, parse_media_from_content
+
+
+def _unwrap_tweet_result(tweet: dict) -> dict:
+    # Accepts a TweetDetail entry, a tweet_results / retweeted_status_result / quoted_status_result, or the result.
+    if 'entryId' in tweet:
+        tweet = tweet.get('content', {}).get('itemContent', {}).get('tweet_results', {})
+    tweet = tweet.get('result', tweet)
+    if 'legacy' not in tweet and 'tweet' in tweet:
+        # TweetWithVisibilityResults
+        tweet = tweet['tweet']
+    return tweet
+
+
+class TweetView():
+    # Pulls the fields used by the tweet / like monitors out of a tweet dict in one pass,
+    # falls back to find_one only when the expected structure is missing.
+    __slots__ = ('tweet', 'typename', 'rest_id', 'content', 'user', 'user_id', 'screen_name', 'user_label_type', 'card',
+                 'source', 'is_note_tweet', 'note_text', 'photo_url_list', 'video_url_list', 'retweet', 'quote')
+
+    def __init__(self, tweet: Union[dict, None]):
+        tweet = tweet or {}
+        self.tweet = tweet
+        result = tweet.get('result', tweet)
+        self.typename = result.get('__typename', None) if isinstance(result, dict) else None
+        result = _unwrap_tweet_result(tweet)
+        if 'legacy' not in result:
+            self._init_by_search(tweet)
+            return
+
+        self.rest_id = result.get('rest_id', None)
+        self.content = result['legacy']
+        self.user = result.get('core', {}).get('user_results', {}).get('result', None)
+        if self.user is None:
+            self.user = find_one(result, 'user_results') or {}
+        self.user_id = self.user.get('rest_id', None)
+        self.screen_name = self.user.get('core', {}).get('screen_name', None) or self.user.get('legacy', {}).get(
+            'screen_name', None) or find_one(self.user, 'screen_name')
+        self.user_label_type = self.user.get('affiliates_highlighted_label', {}).get('label',
+                                                                                     {}).get('userLabelType', None)
+        self.card = result.get('card', None)
+        self.source = result.get('source', None)
+        self.is_note_tweet = 'note_tweet' in result
+        self.note_text = result.get('note_tweet', {}).get('note_tweet_results', {}).get('result', {}).get('text', None)
+        self.photo_url_list, self.video_url_list = parse_media_from_content(self.content)
+        retweet = self.content.get('retweeted_status_result', None)
+        self.retweet = TweetView(retweet) if retweet else None
+        quote = result.get('quoted_status_result', None)
+        self.quote = TweetView(quote) if quote else None
+
+    def _init_by_search(self, tweet: dict):
+        # Unknown structure, search the whole dict as before
+        self.rest_id = find_one(tweet, 'rest_id')
+        self.content = get_content(tweet) or {}
+        self.user = find_one(tweet, 'user_results') or {}
+        self.user_id = find_one(self.user, 'rest_id')
+        self.screen_name = find_one(self.user, 'screen_name')
+        self.user_label_type = find_one(tweet, 'userLabelType')
+        self.card = find_one(tweet, 'card')
+        self.source = find_one(tweet, 'source')
+        self.is_note_tweet = find_one(tweet, 'note_tweet') is not None
+        self.note_text = None
+        self.photo_url_list, self.video_url_list = parse_media_from_content(self.content)
+        retweet = find_one(tweet, 'retweeted_status_result')
+        self.retweet = TweetView(retweet) if retweet else None
+        quote = find_one(tweet, 'quoted_status_result')
+        self.quote = TweetView(quote) if quote else None
+
+    @property
+    def full_text(self) -> str:
+        return self.content.get('full_text', '')
+
+    @property
+    def text(self) -> str:
+        return convert_html_to_text(self.full_text)
+
+    @property
+    def source_text(self) -> str:
+        return convert_source_to_text(self.source) if self.source else ''
+
+    @property
+    def create_time(self) -> datetime:
+        created_at = self.content.get('created_at', None)
+        if not created_at:
+            return datetime.fromtimestamp(0).replace(tzinfo=timezone.utc)
+        return datetime.strptime(created_at, '%a %b %d %H:%M:%S %z %Y')
+
+    def is_complete(self) -> bool:
+        # Whether the fields used by the tweet monitor are all here, so that TweetDetail would add nothing.
+        if self.rest_id is None or not self.content or self.source is None or self.screen_name is None:
+            return False
+        if self.content.get('truncated', False) or (self.is_note_tweet and self.note_text is None):
+            return False
+        if self.retweet is not None:
+            # Only the media of the retweeted tweet is used.
+            return bool(self.retweet.content)
+        if self.content.get('is_quote_status', False) and (self.quote is None or not self.quote.content or
+                                                           self.quote.screen_name is None):
+            return False
+        return True
+
+    def is_advertiser(self) -> bool:
+        if self.card:
+            return True
+        if self.user_label_type == 'BusinessLabel':
+            return True
+        if self.typename == 'TweetWithVisibilityResultss':
+            return True
+        if self.source and ('Advertiser' in self.source or 'advertiser' in self.source):
+            return True
+        return False
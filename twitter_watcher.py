@@ -1,13 +1,21 @@
+import asyncio
 import json
 import logging
 import os
 import random
+import threading
 import time
-from typing import List, Union
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from typing import Awaitable, Callable, List, Tuple, Union
 
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
 from graphql_api import GraphqlAPI
+from metrics import Metrics
 from utils import find_one
 
 
@@ -29,9 +37,303 @@ def _build_params(params: dict) -> dict:
     return {k: json.dumps(v) for k, v in params.items()}
 
 
+class PoolStats():
+    # Shared by all pooled sessions, read by TwitterWatcherManager.get_pool_stats
+
+    def __new__(self):
+        raise Exception('Do not instantiate this class!')
+
+    lock = threading.Lock()
+    request_count = 0
+    connection_count = 0
+    handshake_time = 0.0
+
+    @classmethod
+    def record_request(cls):
+        with cls.lock:
+            cls.request_count += 1
+
+    @classmethod
+    def record_connection(cls, handshake_time: float):
+        with cls.lock:
+            cls.connection_count += 1
+            cls.handshake_time += handshake_time
+
+    @classmethod
+    def get(cls) -> dict:
+        with cls.lock:
+            reused = max(cls.request_count - cls.connection_count, 0)
+            average_handshake_time = cls.handshake_time / cls.connection_count if cls.connection_count else 0.0
+            return {
+                'requests': cls.request_count,
+                'connections_opened': cls.connection_count,
+                'connections_reused': reused,
+                'handshake_time_saved': round(reused * average_handshake_time, 3),
+            }
+
+
+class _TimedHTTPConnection(HTTPConnection):
+
+    def connect(self):
+        start_time = time.perf_counter()
+        super().connect()
+        PoolStats.record_connection(time.perf_counter() - start_time)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+
+    def connect(self):
+        start_time = time.perf_counter()
+        super().connect()
+        PoolStats.record_connection(time.perf_counter() - start_time)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    # Keep-alive adapter which counts requests and new connections (including TCP/TLS handshake time)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _TimedHTTPConnectionPool, 'https': _TimedHTTPSConnectionPool}
+
+    def send(self, request, *args, **kwargs):
+        PoolStats.record_request()
+        return super().send(request, *args, **kwargs)
+
+
+def create_pooled_session(pool_maxsize: int) -> requests.Session:
+    session = requests.Session()
+    # Auth cookies are set in the headers of each request, do not let responses pollute the shared session.
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = PooledHTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class TokenBudget():
+    # Per token, per endpoint rate limit budget, learned from the x-rate-limit-* response headers.
+    # Unknown budgets (no response yet, or the window has been reset) are treated as unlimited.
+    default_reset_seconds = 15 * 60
+
+    def __init__(self, token_number: int):
+        self.token_number = token_number
+        self.budgets = dict()
+        self.lock = threading.Lock()
+
+    def update(self, api_name: str, token_index: int, headers: dict):
+        remaining = headers.get('x-rate-limit-remaining', None)
+        reset_time = headers.get('x-rate-limit-reset', None)
+        if remaining is None or reset_time is None:
+            return
+        try:
+            budget = (int(remaining), int(reset_time))
+        except ValueError:
+            return
+        with self.lock:
+            self.budgets[(api_name, token_index)] = budget
+
+    def exhaust(self, api_name: str, token_index: int, headers: dict):
+        try:
+            reset_time = int(headers.get('x-rate-limit-reset', 0))
+        except ValueError:
+            reset_time = 0
+        if reset_time <= time.time():
+            reset_time = int(time.time()) + self.default_reset_seconds
+        with self.lock:
+            self.budgets[(api_name, token_index)] = (0, reset_time)
+
+    def get_token_order(self, api_name: str, start_index: int) -> List[int]:
+        # Tokens sorted by remaining quota, ties keep the round-robin order. Exhausted tokens are skipped.
+        now = time.time()
+        candidates = []
+        with self.lock:
+            for offset in range(self.token_number):
+                token_index = (start_index + offset) % self.token_number
+                remaining, reset_time = self.budgets.get((api_name, token_index), (None, 0))
+                if reset_time <= now:
+                    remaining = None
+                if remaining is not None and remaining <= 0:
+                    continue
+                candidates.append((token_index, remaining))
+        candidates.sort(key=lambda candidate: float('inf') if candidate[1] is None else candidate[1], reverse=True)
+        return [token_index for token_index, _ in candidates]
+
+    def reserve(self, api_name: str, token_index: int):
+        # Count the request in advance, so concurrent queries do not all pick the same token.
+        with self.lock:
+            budget = self.budgets.get((api_name, token_index), None)
+            if budget and budget[0] > 0:
+                self.budgets[(api_name, token_index)] = (budget[0] - 1, budget[1])
+
+    def get_next_reset_time(self, api_name: str) -> int:
+        with self.lock:
+            reset_time_list = [
+                self.budgets.get((api_name, token_index), (None, 0))[1] for token_index in range(self.token_number)
+            ]
+        return min(reset_time_list)
+
+    def status(self) -> dict:
+        now = time.time()
+        result = dict()
+        with self.lock:
+            for (api_name, token_index), (remaining, reset_time) in self.budgets.items():
+                if reset_time > now:
+                    result.setdefault(api_name, dict())[token_index] = remaining
+        return result
+
+
+class _Flight():
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class QueryCache():
+    # Merges identical queries in flight into one request (single-flight), and keeps the successful responses of the
+    # endpoints in ttl for that many seconds. Other endpoints, like the timelines, are polled for changes and only
+    # merged. Polls pass use_cache=False: ElementBuffer confirms a profile change with two independent polls, a cached
+    # response would count twice.
+    ttl = {'UserByScreenName': 5, 'TweetDetail': 60}
+    max_size = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key: (expire_time, response)
+        self.responses = dict()
+        self.flights = dict()
+        self.async_flights = dict()
+        self.hits = 0
+        self.merged = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(api_name: str, params: dict) -> tuple:
+        return api_name, json.dumps(params, sort_keys=True)
+
+    def _get_cached(self, key: tuple) -> Union[dict, list, None]:
+        # Must be called with the lock held.
+        cached = self.responses.get(key, None)
+        if cached is None:
+            return None
+        if cached[0] <= time.monotonic():
+            del self.responses[key]
+            return None
+        self.hits += 1
+        Metrics.inc('twitter_query_cache_total', api=key[0], result='hit')
+        return cached[1]
+
+    def _record(self, key: tuple, merged: bool):
+        # Must be called with the lock held.
+        if merged:
+            self.merged += 1
+        else:
+            self.misses += 1
+        Metrics.inc('twitter_query_cache_total', api=key[0], result='merged' if merged else 'miss')
+
+    def _put(self, key: tuple, response: Union[dict, list, None]):
+        ttl = self.ttl.get(key[0], 0)
+        if response is None or ttl <= 0:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.responses[key] = (now + ttl, response)
+            if len(self.responses) > self.max_size:
+                expired_key_list = [cached_key for cached_key, cached in self.responses.items() if cached[0] <= now]
+                for expired_key in expired_key_list:
+                    del self.responses[expired_key]
+                while len(self.responses) > self.max_size:
+                    del self.responses[next(iter(self.responses))]
+
+    def query(self,
+              key: tuple,
+              query_func: Callable[[], Union[dict, list, None]],
+              use_cache: bool = True) -> Union[dict, list, None]:
+        with self.lock:
+            response = self._get_cached(key) if use_cache else None
+            if response is not None:
+                return response
+            flight = self.flights.get(key, None)
+            is_leader = flight is None
+            if is_leader:
+                flight = self.flights[key] = _Flight()
+            self._record(key, merged=not is_leader)
+        if not is_leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response
+        try:
+            flight.response = query_func()
+            if use_cache:
+                self._put(key, flight.response)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+        return flight.response
+
+    async def query_async(self,
+                          key: tuple,
+                          query_func: Callable[[], Awaitable[Union[dict, list, None]]],
+                          use_cache: bool = True) -> Union[dict, list, None]:
+        with self.lock:
+            response = self._get_cached(key) if use_cache else None
+            if response is not None:
+                return response
+            future = self.async_flights.get(key, None)
+            is_leader = future is None
+            if is_leader:
+                future = self.async_flights[key] = asyncio.get_running_loop().create_future()
+            self._record(key, merged=not is_leader)
+        if not is_leader:
+            # Shielded, so a cancelled follower does not cancel the query of the others.
+            return await asyncio.shield(future)
+        try:
+            response = await query_func()
+            if use_cache:
+                self._put(key, response)
+            future.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved, the followers may be none.
+            future.exception()
+            raise
+        finally:
+            with self.lock:
+                del self.async_flights[key]
+
+    def status(self) -> dict:
+        with self.lock:
+            total = self.hits + self.merged + self.misses
+            return {
+                'hits': self.hits,
+                'merged': self.merged,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.merged) / total, 3) if total else 0.0,
+                'cached': len(self.responses)
+            }
+
+
 class TwitterWatcher:
 
-    def __init__(self, auth_username_list: List[str], cookies_dir: str):
+    def __init__(self, auth_username_list: List[str], cookies_dir: str, session: requests.Session = None):
         assert auth_username_list
         self.token_number = len(auth_username_list)
         self.auth_cookie_list = []
@@ -41,42 +343,116 @@ class TwitterWatcher:
                 self.auth_cookie_list.append(json.load(f))
                 self.auth_cookie_list[-1]['username'] = auth_username
         self.current_token_index = random.randrange(self.token_number)
+        self.token_budget = TokenBudget(self.token_number)
+        self.user_id_cache = dict()
+        self.query_cache = QueryCache()
+        self.session = session if session is not None else create_pooled_session(pool_maxsize=self.token_number)
         self.logger = logging.getLogger('api')
 
-    def query(self, api_name: str, params: dict) -> Union[dict, list, None]:
+    def _prepare_query(self, api_name: str, params: dict) -> Tuple[str, str, dict, dict, List[int]]:
         url, method, headers, features = GraphqlAPI.get_api_data(api_name)
         params = _build_params({"variables": params, "features": features})
-        for _ in range(self.token_number):
-            self.current_token_index = (self.current_token_index + 1) % self.token_number
-            auth_headers = _get_auth_headers(headers, self.auth_cookie_list[self.current_token_index])
+        self.current_token_index = (self.current_token_index + 1) % self.token_number
+        token_index_list = self.token_budget.get_token_order(api_name, self.current_token_index)
+        if not token_index_list:
+            self.logger.error('All tokens are rate limited, query skipped: {}, next reset at {}'.format(
+                url, self.token_budget.get_next_reset_time(api_name)))
+        return url, method, headers, params, token_index_list
+
+    def _parse_response(self, api_name: str, url: str, token_index: int,
+                        response: Union[requests.Response, httpx.Response]) -> Union[dict, list, None]:
+        # Returns None if the next token should be tried.
+        if response.status_code == 429:
+            # 429 TWEET_RATE_LIMIT_EXCEEDED
+            self.token_budget.exhaust(api_name, token_index, response.headers)
+            return None
+        self.token_budget.update(api_name, token_index, response.headers)
+        if response.status_code in [200, 404, 403]:
+            # 404 NOT_FOUND
+            # 403 CURRENT_USER_SUSPENDED
+            if not response.text:
+                self.logger.error('{} response empty {}, try next token.'.format(url, response.status_code))
+                return None
             try:
-                response = requests.request(method=method, url=url, headers=auth_headers, params=params, timeout=300)
+                json_response = response.json()
+            except json.decoder.JSONDecodeError as e:
+                print("Response JSON decode failed, text: {}".format(response.text))
+                raise e
+            if 'errors' in json_response:
+                self.logger.error('{} request error: {} {}, try next token.'.format(url, response.status_code,
+                                                                                    json_response['errors']))
+                return None
+            return json_response
+        self.logger.error('{} request returned an error: {} {}, try next token.'.format(
+            url, response.status_code, response.text))
+        return None
+
+    def _record_metrics(self, api_name: str, token_index: int, status: str, duration: float, succeeded: bool):
+        Metrics.observe('twitter_api_request_duration_seconds', duration, api=api_name)
+        Metrics.inc('twitter_api_responses_total', api=api_name, status=status)
+        result = 'success' if succeeded else 'rate_limited' if status == '429' else 'failure'
+        Metrics.inc('twitter_token_requests_total', token=self.auth_cookie_list[token_index]['username'], result=result)
+
+    def query(self, api_name: str, params: dict, use_cache: bool = True) -> Union[dict, list, None]:
+        return self.query_cache.query(QueryCache.get_key(api_name, params), lambda: self._query(api_name, params),
+                                      use_cache)
+
+    async def query_async(self, api_name: str, params: dict, use_cache: bool = True) -> Union[dict, list, None]:
+        return await self.query_cache.query_async(QueryCache.get_key(api_name, params),
+                                                  lambda: self._query_async(api_name, params), use_cache)
+
+    def _query(self, api_name: str, params: dict) -> Union[dict, list, None]:
+        url, method, headers, params, token_index_list = self._prepare_query(api_name, params)
+        for token_index in token_index_list:
+            auth_headers = _get_auth_headers(headers, self.auth_cookie_list[token_index])
+            self.token_budget.reserve(api_name, token_index)
+            start_time = time.perf_counter()
+            try:
+                response = self.session.request(method=method,
+                                                url=url,
+                                                headers=auth_headers,
+                                                params=params,
+                                                timeout=300)
             except requests.exceptions.ConnectionError as e:
+                self._record_metrics(api_name, token_index, 'error', time.perf_counter() - start_time, False)
                 self.logger.error('{} request error: {}, try next token.'.format(url, e))
                 continue
-            if response.status_code in [200, 404, 403]:
-                # 404 NOT_FOUND
-                # 403 CURRENT_USER_SUSPENDED
-                if not response.text:
-                    self.logger.error('{} response empty {}, try next token.'.format(url, response.status_code))
-                    continue
-                try:
-                    json_response = response.json()
-                except json.decoder.JSONDecodeError as e:
-                    print("Response JSON decode failed, text: {}".format(response.text))
-                    raise e
-                if 'errors' in json_response:
-                    self.logger.error('{} request error: {} {}, try next token.'.format(
-                        url, response.status_code, json_response['errors']))
-                    continue
+            json_response = self._parse_response(api_name, url, token_index, response)
+            self._record_metrics(api_name, token_index, str(response.status_code),
+                                 time.perf_counter() - start_time, json_response is not None)
+            if json_response is not None:
                 return json_response
-            if response.status_code != 429:
-                # 429 TWEET_RATE_LIMIT_EXCEEDED
-                self.logger.error('{} request returned an error: {} {}, try next token.'.format(
-                    url, response.status_code, response.text))
+        if token_index_list:
+            self.logger.error('All tokens are unavailable, query fails: {}\n{}\n{}'.format(
+                url, json.dumps(auth_headers, indent=2), json.dumps(params, indent=2)))
+        return None
+
+    async def _query_async(self, api_name: str, params: dict) -> Union[dict, list, None]:
+        url, method, headers, params, token_index_list = self._prepare_query(api_name, params)
+        client = TwitterWatcherManager.get_async_client()
+        for token_index in token_index_list:
+            auth_headers = _get_auth_headers(headers, self.auth_cookie_list[token_index])
+            self.token_budget.reserve(api_name, token_index)
+            try:
+                async with TwitterWatcherManager.get_async_semaphore():
+                    start_time = time.perf_counter()
+                    response = await client.request(method=method,
+                                                    url=url,
+                                                    headers=auth_headers,
+                                                    params=params,
+                                                    timeout=300)
+            except httpx.TransportError as e:
+                self._record_metrics(api_name, token_index, 'error', time.perf_counter() - start_time, False)
+                self.logger.error('{} request error: {}, try next token.'.format(url, e))
                 continue
-        self.logger.error('All tokens are unavailable, query fails: {}\n{}\n{}'.format(
-            url, json.dumps(auth_headers, indent=2), json.dumps(params, indent=2)))
+            json_response = self._parse_response(api_name, url, token_index, response)
+            self._record_metrics(api_name, token_index, str(response.status_code),
+                                 time.perf_counter() - start_time, json_response is not None)
+            if json_response is not None:
+                return json_response
+        if token_index_list:
+            self.logger.error('All tokens are unavailable, query fails: {}\n{}\n{}'.format(
+                url, json.dumps(auth_headers, indent=2), json.dumps(params, indent=2)))
         return None
 
     def get_user_by_username(self, username: str, params: dict = {}) -> dict:
@@ -98,21 +474,36 @@ class TwitterWatcher:
         return json_response
 
     def get_id_by_username(self, username: str):
+        # User id never changes, resolve each username only once.
+        user_id = self.user_id_cache.get(username, None)
+        if user_id:
+            return user_id
         json_response = self.get_user_by_username(username, {})
-        return find_one(json_response, 'rest_id')
+        user_id = find_one(json_response, 'rest_id')
+        if user_id:
+            self.user_id_cache[username] = user_id
+        return user_id
 
     def check_tokens(self, test_username: str = 'X', output_response: bool = False):
         result = dict()
-        for auth_cookie in self.auth_cookie_list:
+        for token_index, auth_cookie in enumerate(self.auth_cookie_list):
             try:
                 url, method, headers, features = GraphqlAPI.get_api_data('UserByScreenName')
                 params = _build_params({"variables": {'screen_name': test_username}, "features": features})
                 auth_headers = _get_auth_headers(headers, auth_cookie)
-                response = requests.request(method=method, url=url, headers=auth_headers, params=params, timeout=300)
+                response = self.session.request(method=method,
+                                                url=url,
+                                                headers=auth_headers,
+                                                params=params,
+                                                timeout=300)
             except requests.exceptions.ConnectionError as e:
                 result[auth_cookie['username']] = False
                 print(e)
                 continue
+            if response.status_code == 429:
+                self.token_budget.exhaust('UserByScreenName', token_index, response.headers)
+            else:
+                self.token_budget.update('UserByScreenName', token_index, response.headers)
             result[auth_cookie['username']] = (response.status_code == 200)
             if output_response:
                 try:
@@ -122,3 +513,59 @@ class TwitterWatcher:
                     raise e
                 print(json.dumps(json_response, indent=2))
         return result
+
+
+class TwitterWatcherManager():
+    # Process-wide registry, all monitors with the same tokens share one watcher and one connection pool.
+    pool_maxsize = 32
+    max_concurrency = 100
+    session = None
+    async_client = None
+    async_semaphore = None
+    watchers = dict()
+    lock = threading.Lock()
+
+    def __new__(self):
+        raise Exception('Do not instantiate this class!')
+
+    @classmethod
+    def init(cls, pool_maxsize: int):
+        with cls.lock:
+            cls.pool_maxsize = max(pool_maxsize, 1)
+
+    @classmethod
+    def get(cls, auth_username_list: List[str], cookies_dir: str) -> TwitterWatcher:
+        key = (tuple(auth_username_list), os.path.abspath(cookies_dir))
+        with cls.lock:
+            if cls.session is None:
+                cls.session = create_pooled_session(pool_maxsize=cls.pool_maxsize)
+            watcher = cls.watchers.get(key, None)
+            if watcher is None:
+                watcher = TwitterWatcher(auth_username_list, cookies_dir, session=cls.session)
+                cls.watchers[key] = watcher
+            return watcher
+
+    @classmethod
+    def init_async(cls, max_concurrency: int):
+        with cls.lock:
+            cls.max_concurrency = max(max_concurrency, 1)
+
+    @classmethod
+    def get_async_client(cls) -> httpx.AsyncClient:
+        # Must be called in the running event loop of the asyncio engine.
+        if cls.async_client is None:
+            limits = httpx.Limits(max_connections=cls.max_concurrency, max_keepalive_connections=cls.max_concurrency)
+            # Auth cookies are set in the headers of each request, do not let responses pollute the shared client.
+            cls.async_client = httpx.AsyncClient(limits=limits,
+                                                 cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])))
+        return cls.async_client
+
+    @classmethod
+    def get_async_semaphore(cls) -> asyncio.Semaphore:
+        if cls.async_semaphore is None:
+            cls.async_semaphore = asyncio.Semaphore(cls.max_concurrency)
+        return cls.async_semaphore
+
+    @classmethod
+    def get_pool_stats(cls) -> dict:
+        return PoolStats.get()
@@ -1,15 +1,26 @@
 from collections import deque
 from datetime import datetime, timezone
+from functools import lru_cache
+from html import unescape
 from typing import Tuple
 
 from bs4 import BeautifulSoup
 
 
 def convert_html_to_text(html: str) -> str:
+    # Tweet text is entity escaped but rarely has tags, which is all the parser is needed for.
+    if '<' not in html:
+        return unescape(html)
     bs = BeautifulSoup(html, "html.parser")
     return bs.get_text()
 
 
+@lru_cache(maxsize=256)
+def convert_source_to_text(source: str) -> str:
+    # Sources are anchors of a handful of client apps.
+    return convert_html_to_text(source)
+
+
 def get_photo_url_from_media(media: dict) -> str:
     return media.get('media_url_https', '')
 
@@ -28,9 +39,12 @@ def get_video_url_from_media(media: dict) -> str:
 
 
 def parse_media_from_tweet(tweet: dict) -> Tuple[list, list]:
+    return parse_media_from_content(get_content(tweet))
+
+
+def parse_media_from_content(tweet_content: dict) -> Tuple[list, list]:
     photo_url_list = []
     video_url_list = []
-    tweet_content = get_content(tweet)
     medias = tweet_content.get('extended_entities', {}).get('media', [])
     for media in medias:
         media_type = media.get('type', '')
@@ -60,21 +74,22 @@ def parse_create_time_from_tweet(tweet: dict) -> datetime.time:
 
 def find_all(obj: any, key: str) -> list:
     # DFS
-    def dfs(obj: any, key: str, res: list) -> list:
+    def dfs(obj: any, key: str, res: list):
         if not obj:
-            return res
+            return
         if isinstance(obj, list):
             for e in obj:
-                res.extend(dfs(e, key, []))
-            return res
+                dfs(e, key, res)
+            return
         if isinstance(obj, dict):
             if key in obj:
                 res.append(obj[key])
             for v in obj.values():
-                res.extend(dfs(v, key, []))
-        return res
+                dfs(v, key, res)
 
-    return dfs(obj, key, [])
+    res = []
+    dfs(obj, key, res)
+    return res
 
 
 def find_one(obj: any, key: str) -> any:
@@ -92,12 +107,92 @@ def find_one(obj: any, key: str) -> any:
     return None
 
 
+class PathExtractor():
+    # Resolve values by declared paths with a direct walk instead of searching the whole response.
+    # Path steps are separated by '.', '*' iterates over a list, 'a|b' takes the first existing key.
+    # When no path matches (the schema drifted), fall back to find_one / find_all with fallback_key.
+
+    def __init__(self, *paths: str, fallback_key: str):
+        tree = dict()
+        for path in paths:
+            node = tree
+            for step in path.split('.'):
+                node = node.setdefault(step, dict())
+        self.tree = self._compile(tree)
+        self.fallback_key = fallback_key
+
+    @classmethod
+    def _compile(cls, tree: dict) -> list:
+        return [
+            (None if step == '*' else tuple(step.split('|')), cls._compile(subtree)) for step, subtree in tree.items()
+        ]
+
+    @classmethod
+    def _walk(cls, obj: any, tree: list, res: list, limit: int):
+        if not tree:
+            res.append(obj)
+            return
+        for keys, subtree in tree:
+            if keys is None:
+                if isinstance(obj, list):
+                    for e in obj:
+                        cls._walk(e, subtree, res, limit)
+                        if len(res) >= limit:
+                            return
+            elif isinstance(obj, dict):
+                for key in keys:
+                    if key in obj:
+                        cls._walk(obj[key], subtree, res, limit)
+                        break
+            if len(res) >= limit:
+                return
+
+    def extract_all(self, obj: any) -> list:
+        res = []
+        self._walk(obj, self.tree, res, float('inf'))
+        if not res:
+            return find_all(obj, self.fallback_key)
+        return res
+
+    def extract_one(self, obj: any) -> any:
+        res = []
+        self._walk(obj, self.tree, res, 1)
+        if not res:
+            return find_one(obj, self.fallback_key)
+        return res[0]
+
+
+_TIMELINE_INSTRUCTIONS = 'data.user.result.timeline_v2|timeline.timeline.instructions.*'
+
+TIMELINE_ENTRIES = PathExtractor(_TIMELINE_INSTRUCTIONS + '.entries', fallback_key='entries')
+
+TIMELINE_TWEET_RESULTS = PathExtractor(_TIMELINE_INSTRUCTIONS + '.entry.content.itemContent.tweet_results',
+                                       _TIMELINE_INSTRUCTIONS + '.entries.*.content.itemContent.tweet_results',
+                                       _TIMELINE_INSTRUCTIONS +
+                                       '.entries.*.content.items.*.item.itemContent.tweet_results',
+                                       fallback_key='tweet_results')
+
+TIMELINE_USER_RESULTS = PathExtractor(_TIMELINE_INSTRUCTIONS + '.entries.*.content.itemContent.user_results',
+                                      fallback_key='user_results')
+
+USER_RESULT = PathExtractor('data.user', fallback_key='user')
+
+USERS = PathExtractor('data.users', fallback_key='users')
+
+# Content of a user result, a tweet result (also wrapped by TweetWithVisibilityResults) or a TweetDetail entry
+CONTENT = PathExtractor('result.legacy',
+                        'result.tweet.legacy',
+                        'content.itemContent.tweet_results.result.legacy',
+                        'content.itemContent.tweet_results.result.tweet.legacy',
+                        fallback_key='legacy')
+
+
 def get_content(obj: dict) -> dict:
-    return find_one(obj, 'legacy')
+    return CONTENT.extract_one(obj)
 
 
 def get_cursor(obj: any) -> str:
-    entries = find_one(obj, 'entries')
+    entries = TIMELINE_ENTRIES.extract_one(obj)
     for entry in entries:
         entry_id = entry.get('entryId', '')
         if entry_id.startswith('cursor-bottom'):